@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Pipeline overhead benchmark for kernel_customizer.py
+
+Builds a synthetic kernel tree (a defconfig with thousands of options, a
+NetHunter-style series of hundreds of patches, local file:// git repositories)
+and times the customizer's own work on it: cloning, config tweaks, patching and
+the full main() path. `wsl` is replaced by a bash stand-in and `make` by a stub,
+so only the customizer's overhead is measured.
+
+Results are compared against baseline.json next to this script; a run fails
+when commands or process spawns go up at all, or wall time or memory grow past
+the tolerance.
+"""
+
+import os
+import sys
+import json
+import re
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+import contextlib
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+TOOLS_DIR = Path(__file__).resolve().parent.parent
+BASELINE_PATH = Path(__file__).resolve().parent / "baseline.json"
+DISTRO_NAME = "bench-linux"
+DEFCONFIG_TEMPLATE = "arch/arm64/configs/{codename}_defconfig"
+# Absolute wall time slack on top of --tolerance, so sub-second stages do not flap
+WALL_TIME_SLACK_SECONDS = 0.5
+
+# `wsl` stand-in: answers the status/list probes and runs `wsl -d <distro> -- <argv>` locally
+FAKE_WSL = """#!/bin/bash
+case "$1" in
+  --status) echo "Default Distribution: {distro}"; exit 0;;
+  --list) echo "{distro}"; exit 0;;
+  -d) shift 2; [ "$1" = "--" ] && shift; exec "$@";;
+esac
+exit 1
+"""
+
+# `make` stub: config targets copy the defconfig, a -j build prints kbuild lines and leaves an image
+FAKE_MAKE = """#!/bin/bash
+out=.
+target=
+for a in "$@"; do case "$a" in O=*) out="${{a#O=}}";; *defconfig) target="$a";; esac; done
+case "$*" in
+  *mrproper*|*clean*) rm -f .config;;
+  *olddefconfig*) ;;
+  *defconfig*) mkdir -p "$out" && cp "arch/arm64/configs/$target" "$out/.config";;
+  *-j*)
+    for i in $(seq 1 {objects}); do echo "  CC      drivers/bench/obj$i.o"; done
+    mkdir -p "$out/arch/arm64/boot" && echo image > "$out/arch/arm64/boot/Image";;
+esac
+"""
+
+def log(message: str):
+    print(message, file=sys.stderr)
+
+def git(cwd: Path, *args):
+    subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True)
+
+def make_executable(path: Path, text: str):
+    path.write_text(text, encoding="utf-8")
+    path.chmod(0o755)
+
+def opposite_config_line(line: str) -> str:
+    """Return line with the option flipped: set options become unset, unset ones built in."""
+    match = re.match(r"# (CONFIG_\w+) is not set", line)
+    if match:
+        return f"{match.group(1)}=y"
+    key, value = line.split("=", 1)
+    return f"# {key} is not set" if value == "y" else f"{key}=y"
+
+def create_kernel_repo(root: Path, options: int, patches: int, feature_lines: list) -> Path:
+    """Create a git repo with a large defconfig and one source file per patch."""
+    repo = root / "kernel.git-src"
+    configs_dir = repo / "arch/arm64/configs"
+    configs_dir.mkdir(parents=True)
+    lines = [f"CONFIG_BENCH_OPTION_{i}={'y' if i % 3 else 'm'}" for i in range(options)]
+    # Half of the feature options are set already and half have the opposite value,
+    # so the tweak engine has real lookups to do and a changed defconfig to write
+    lines.extend(line if i % 2 else opposite_config_line(line) for i, line in enumerate(feature_lines))
+    (configs_dir / "bench_defconfig").write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+    sources = repo / "drivers/bench"
+    sources.mkdir(parents=True)
+    for i in range(patches):
+        (sources / f"file_{i}.c").write_text(f"/* bench file {i} */\nint bench_{i};\n\n", encoding="utf-8")
+    (repo / "Makefile").write_text("# synthetic kernel\n", encoding="utf-8")
+
+    git(repo, "init", "-q", "-b", "android-bench")
+    git(repo, "add", "-A")
+    git(repo, "-c", "user.name=bench", "-c", "user.email=bench@localhost", "commit", "-q", "-m", "synthetic kernel")
+    return repo
+
+def create_nethunter_repo(root: Path, patches: int) -> Path:
+    """Create a git repo with a series of small patches against the synthetic kernel."""
+    repo = root / "nethunter.git-src"
+    patch_dir = repo / "nethunter-kernel-patches"
+    patch_dir.mkdir(parents=True)
+    for i in range(patches):
+        (patch_dir / f"{i:04d}-bench-{i}.patch").write_text(
+            f"--- a/drivers/bench/file_{i}.c\n"
+            f"+++ b/drivers/bench/file_{i}.c\n"
+            f"@@ -1,3 +1,4 @@\n"
+            f" /* bench file {i} */\n"
+            f" int bench_{i};\n"
+            f"+int nethunter_{i};\n"
+            f" \n",
+            encoding="utf-8")
+    git(repo, "init", "-q", "-b", "master")
+    git(repo, "add", "-A")
+    git(repo, "-c", "user.name=bench", "-c", "user.email=bench@localhost", "commit", "-q", "-m", "patch series")
+    return repo
+
+def rusage_peak_kb():
+    if resource is None:
+        return None
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+class Benchmark:
+    """Holds the synthetic workspace and runs each scenario against a fresh output dir."""
+
+    def __init__(self, kc, workspace: Path, args):
+        self.kc = kc
+        self.workspace = workspace
+        self.args = args
+        feature_lines = [line for lines in kc.FEATURE_CONFIGS.values() for line in lines]
+        self.kernel_repo = create_kernel_repo(workspace, args.options, args.patches, feature_lines)
+        self.nethunter_repo = create_nethunter_repo(workspace, args.patches)
+        self.config_path = workspace / "bench_config.json"
+        self.base_config = {
+            "device": "bench",
+            "codename": "bench",
+            "wsl_distro_name": DISTRO_NAME,
+            "wsl_backend": args.backend,
+            "kernel_repo": f"file://{self.kernel_repo}",
+            "kernel_branch": "android-bench",
+            "nethunter_patches_repo": f"file://{self.nethunter_repo}",
+            "nethunter_patches_branch": "master",
+            "defconfig_filename_template": DEFCONFIG_TEMPLATE,
+            "output_dir": str(workspace / "output"),
+            "kernel_estimated_objects": args.objects,
+            "ccache_enabled": False,
+            "artifact_cache": False,
+            "make_jobs": 2,
+        }
+        self.config_path.write_text(json.dumps(self.base_config, indent=2), encoding="utf-8")
+
+    def fresh_config(self) -> dict:
+        shutil.rmtree(self.base_config["output_dir"], ignore_errors=True)
+        return self.kc.load_config(str(self.config_path))
+
+    def measure(self, name: str, func) -> dict:
+        """Run func once inside an instrumented stage and return its numbers."""
+        tracemalloc.start()
+        started = time.perf_counter()
+        with self.kc.instrument_stage(f"bench/{name}") as metrics:
+            func()
+        wall = time.perf_counter() - started
+        _, python_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {
+            "wall_seconds": wall,
+            "commands": metrics.commands,
+            "process_spawns": metrics.process_spawns,
+            "output_bytes": metrics.output_bytes,
+            "python_peak_kb": python_peak // 1024,
+        }
+
+    def scenario_clone(self):
+        config = self.fresh_config()
+        return lambda: self.kc.clone_repositories(config)
+
+    def scenario_config_tweaks(self):
+        config = self.fresh_config()
+        kernel_dir, _ = self.kc.clone_repositories(config)
+        return lambda: self.kc.apply_kernel_config_tweaks(kernel_dir, config)
+
+    def scenario_patches(self):
+        config = self.fresh_config()
+        kernel_dir, nethunter_dir = self.kc.clone_repositories(config)
+
+        def apply():
+            results = self.kc.apply_nethunter_patches(kernel_dir, nethunter_dir, config)
+            applied = sum(1 for status in results.values() if status == "applied")
+            if applied != self.args.patches:
+                raise RuntimeError(f"Expected {self.args.patches} applied patches, got {applied}")
+        return apply
+
+    def scenario_full_main(self):
+        self.fresh_config()
+        argv = ["kernel_customizer.py", "--config", str(self.config_path), "--skip-env-setup"]
+
+        def run_main():
+            saved_argv = sys.argv
+            sys.argv = argv
+            try:
+                self.kc.main()
+            finally:
+                sys.argv = saved_argv
+        return run_main
+
+    def run(self) -> dict:
+        scenarios = {
+            "clone_repositories": self.scenario_clone,
+            "apply_kernel_config_tweaks": self.scenario_config_tweaks,
+            "apply_nethunter_patches": self.scenario_patches,
+            "full_main": self.scenario_full_main,
+        }
+        results = {}
+        for name, prepare in scenarios.items():
+            samples = []
+            for _ in range(self.args.repeat):
+                func = prepare()
+                samples.append(self.measure(name, func))
+            results[name] = {
+                "wall_seconds": round(statistics.median(s["wall_seconds"] for s in samples), 4),
+                "commands": max(s["commands"] for s in samples),
+                "process_spawns": max(s["process_spawns"] for s in samples),
+                "output_bytes": max(s["output_bytes"] for s in samples),
+                "python_peak_kb": max(s["python_peak_kb"] for s in samples),
+            }
+            log(f"{name:28s} {results[name]['wall_seconds']:8.3f}s  "
+                f"{results[name]['commands']:4d} commands  {results[name]['process_spawns']:3d} spawns  "
+                f"{results[name]['python_peak_kb']:7d} KiB peak")
+        return results
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> list:
+    """Return a description of every regression against the stored baseline."""
+    regressions = []
+    for name, current in results.items():
+        expected = baseline.get("stages", {}).get(name)
+        if not expected:
+            continue
+        for key in ("commands", "process_spawns"):
+            if current[key] > expected[key]:
+                regressions.append(f"{name}: {key} went from {expected[key]} to {current[key]}")
+        for key in ("wall_seconds", "python_peak_kb"):
+            limit = expected[key] * (1 + tolerance) + (WALL_TIME_SLACK_SECONDS if key == "wall_seconds" else 0)
+            if current[key] > limit:
+                regressions.append(f"{name}: {key} {current[key]} exceeds baseline {expected[key]} by more than {tolerance:.0%}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure kernel_customizer.py pipeline overhead on a synthetic kernel tree")
+    parser.add_argument("--options", type=int, default=3000, help="Number of options in the synthetic defconfig")
+    parser.add_argument("--patches", type=int, default=300, help="Number of patches in the synthetic NetHunter series")
+    parser.add_argument("--objects", type=int, default=2000, help="Number of kbuild lines the make stub prints")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scenario; the median wall time is reported")
+    parser.add_argument("--backend", choices=["wsl", "native"], default="wsl",
+                        help="Shell backend to exercise; wsl uses the bash stand-in for wsl.exe")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="Allowed relative growth of wall time and memory over the baseline")
+    parser.add_argument("--baseline", default=str(BASELINE_PATH), help="Baseline file to compare with or save to")
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the new baseline")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--keep-workspace", action="store_true", help="Leave the synthetic workspace on disk")
+    args = parser.parse_args()
+
+    workspace = Path(tempfile.mkdtemp(prefix="kc-bench-"))
+    bin_dir = workspace / "bin"
+    bin_dir.mkdir()
+    make_executable(bin_dir / "wsl", FAKE_WSL.replace("{distro}", DISTRO_NAME))
+    make_executable(bin_dir / "make", FAKE_MAKE.format(objects=args.objects))
+    # Every cache the customizer keeps under $HOME stays inside the workspace
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+    os.environ["HOME"] = str(workspace / "home")
+
+    sys.path.insert(0, str(TOOLS_DIR))
+    import kernel_customizer as kc
+    if args.backend == "wsl":
+        # Paths on this machine are already what the bash stand-in sees
+        kc.windows_to_wsl_path = lambda path: str(Path(path).resolve())
+    kc._console_handler.setLevel(logging.WARNING)
+
+    log(f"Synthetic tree: {args.options} defconfig options, {args.patches} patches, "
+        f"{args.objects} objects; workspace {workspace}")
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            benchmark = Benchmark(kc, workspace, args)
+            kc.configure_shell(benchmark.base_config)
+            results = benchmark.run()
+    finally:
+        kc.close_sessions()
+        if not args.keep_workspace:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    report = {
+        "parameters": {key: getattr(args, key) for key in ("options", "patches", "objects", "repeat", "backend")},
+        "peak_rss_kb": rusage_peak_kb(),
+        "stages": results,
+    }
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+    baseline_path = Path(args.baseline)
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps(report, indent=2) + "\n", encoding="utf-8")
+        log(f"Baseline saved to {baseline_path}")
+        return
+    if not baseline_path.exists():
+        log("No baseline to compare with; run with --save-baseline to create one.")
+        return
+
+    baseline = json.loads(baseline_path.read_text(encoding="utf-8"))
+    if baseline.get("parameters") != report["parameters"]:
+        log("Baseline was recorded with different parameters; skipping the comparison.")
+        return
+    regressions = compare_with_baseline(results, baseline, args.tolerance)
+    if regressions:
+        log("Regressions against the baseline:")
+        for regression in regressions:
+            log(f"  {regression}")
+        sys.exit(1)
+    log("No regressions against the baseline.")
+
+if __name__ == "__main__":
+    main()
@@ -8,24 +8,108 @@ GitHub: https://github.com/FiveOs/android-kernel-customizer
 """
 
 import os
+import io
 import subprocess
 import json
 import argparse
 import logging
+import logging.handlers
+import gzip
 import sys
 from pathlib import Path
 import shutil
 import time
+import re
+import hashlib
+import shlex
+import threading
+import queue
+import uuid
+import atexit
+import copy
+import itertools
+import contextlib
+import contextvars
+import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait, as_completed
 
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO, 
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler("kernel_build.log", mode='a')
-    ]
-)
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Set up logging: records are queued by the calling thread and written by a listener
+# thread, so slow disks never stall a build. Console output stays at INFO; every
+# build additionally gets its own rotated JSON-lines log file (see build_log()).
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+# Build, stage and command the current thread is working on, attached to each log record
+_build_id = contextvars.ContextVar("build_id", default=None)
+_command_id = contextvars.ContextVar("command_id", default=None)
+_command_ids = itertools.count(1)
+
+class LogContextFilter(logging.Filter):
+    """Stamps records with the build, stage and command of the thread that logs them."""
+
+    def filter(self, record):
+        stages = _active_stages.get()
+        record.build_id = _build_id.get()
+        record.stage = stages[-1].name if stages else None
+        record.command_id = _command_id.get()
+        return True
+
+class JsonLogFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line for the per-build log files."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "stage": getattr(record, "stage", None),
+            "command_id": getattr(record, "command_id", None),
+            "message": record.getMessage(),
+        }
+        return json.dumps(entry)
+
+class BuildLogRouter(logging.Handler):
+    """Hands each record to the log file of the build it belongs to."""
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.build_handlers = {}
+
+    def emit(self, record):
+        closing = getattr(record, "close_build_log", None)
+        if closing:
+            # Queued after the build's last record, so nothing of it is lost
+            handler = self.build_handlers.pop(closing, None)
+            if handler:
+                handler.close()
+            return
+        handler = self.build_handlers.get(getattr(record, "build_id", None))
+        if handler and record.levelno >= handler.level:
+            handler.handle(record)
+
+def gzip_rotator(source: str, dest: str):
+    """Compress a rotated log file."""
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+_log_queue = queue.SimpleQueue()
+_console_handler = logging.StreamHandler(sys.stdout)
+_console_handler.setLevel(logging.INFO)
+_console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+_build_log_router = BuildLogRouter()
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_queue_handler.addFilter(LogContextFilter())
+logging.getLogger().addHandler(_queue_handler)
+logging.getLogger().setLevel(logging.INFO)
+_log_listener = logging.handlers.QueueListener(_log_queue, _console_handler, _build_log_router,
+                                               respect_handler_level=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Configuration file for kernel customization
@@ -53,19 +137,261 @@ DEFAULT_CONFIG = {
         "rtl8812au_driver": False,
     },
     "custom_kernel_configs": [],
-    "wsl_distro_name": "kali-linux"
+    "kernel_estimated_objects": 6000,
+    "incremental_build": False,
+    "incremental_keep_build_dirs": 3,
+    "ccache_enabled": True,
+    "ccache_dir": "~/.cache/kernel-customizer/ccache",
+    "ccache_max_size": "20G",
+    "distributed_compiler": "",
+    "distributed_hosts": [],
+    "distributed_connect_timeout": 2,
+    "icecc_version": "",
+    "wsl_distro_name": "kali-linux",
+    "wsl_backend": "wsl",
+    "wsl_persistent_session": True,
+    "pipeline_workers": 4,
+    "git_mirror_cache": False,
+    "git_mirror_dir": "~/.cache/kernel-customizer/mirrors",
+    "git_mirror_depth": 1,
+    "git_mirror_refresh": False,
+    "kernel_sparse_checkout": False,
+    "kernel_sparse_exclude": ["Documentation", "samples"],
+    "make_jobs": 0,
+    "matrix_parallel": 2,
+    "toolchain_probe_ttl": 86400,
+    "artifact_cache": True,
+    "artifact_cache_dir": "~/.cache/kernel-customizer/artifacts",
+    "artifact_cache_max_size": "10G",
+    "build_placement": "output_dir",
+    "native_build_dir": "~/.cache/kernel-customizer/builds",
+    "log_level": "DEBUG",
+    "log_max_bytes": 10 * 1024 * 1024,
+    "log_backup_count": 5,
+    "log_keep_builds": 20,
+    "kernel_config_preflight": True,
+    "module_fast_path": True,
+    "preflight_only": False
+}
+
+# Build dependencies installed by setup_wsl_environment, mapped to a binary that
+# proves the package is usable (None: only the package database can tell)
+TOOLCHAIN_PACKAGES = {
+    "git": "git",
+    "python3": "python3",
+    "python3-pip": "pip3",
+    "bison": "bison",
+    "flex": "flex",
+    "gawk": "gawk",
+    "bc": "bc",
+    "ccache": "ccache",
+    "device-tree-compiler": "dtc",
+    "libssl-dev": None,
+    "build-essential": None,
+    "gcc-aarch64-linux-gnu": "aarch64-linux-gnu-gcc",
+    "libncurses5-dev": None,
+    "time": "/usr/bin/time",
+}
+
+# Shells that run_command(wsl=True) can target:
+#   "wsl"    - bash inside the configured WSL distribution, started through wsl.exe
+#   "native" - bash on this machine, for Linux build hosts; paths are used as they are
+SHELL_BACKENDS = ("wsl", "native")
+# Older names still accepted in wsl_backend
+SHELL_BACKEND_ALIASES = {"local": "native"}
+
+# Distributed compilers usable as distributed_compiler, mapped to their daemon's default port
+DISTRIBUTED_COMPILERS = {"distcc": 3632, "icecc": 10245}
+# Compile slots assumed for a host entry without a "/N" limit (distcc's own default)
+DISTRIBUTED_DEFAULT_SLOTS = 4
+DISTCC_LOG_FILE = "distcc.log"
+
+# Architecture directories a sparse kernel checkout keeps for each kernel_arch; other
+# architectures get arch/<kernel_arch>. arm64 still uses arch/arm for its compat vDSO and
+# the DTS includes shared with 32-bit boards.
+SPARSE_ARCH_DIRS = {"arm64": ("arch/arm64", "arch/arm")}
+# Shell pipeline mapping tracked paths on stdin to the sparse cone directories holding them
+SPARSE_CONE_DIRS_AWK = """awk -F/ 'NF > 1 { print ($1 == "arch" && NF > 2) ? $1 "/" $2 : $1 }' | sort -u"""
+
+# Where the kernel and NetHunter checkouts and all object trees live:
+#   "output_dir" - next to the results in output_dir (on WSL, the Windows filesystem)
+#   "native"     - under native_build_dir on the shell's own filesystem; only the
+#                  collected artifacts are copied to output_dir
+BUILD_PLACEMENTS = ("output_dir", "native")
+
+# Kernel options enabled by each feature toggle of the web interface
+FEATURE_CONFIGS = {
+    "wifi_monitor_mode": [
+        "CONFIG_PACKET=y",
+        "CONFIG_CFG80211_WEXT=y",
+        "CONFIG_MAC80211=y",
+        "CONFIG_RFKILL=y",
+    ],
+    "usb_gadget": [
+        "CONFIG_USB_GADGET=y",
+        "CONFIG_USB_CONFIGFS=y",
+        "CONFIG_USB_CONFIGFS_F_FS=y",
+        "CONFIG_USB_CONFIGFS_F_ACM=y",
+        "CONFIG_USB_CONFIGFS_F_ECM=y",
+        "CONFIG_USB_CONFIGFS_F_RNDIS=y",
+    ],
+    "hid_support": [
+        "CONFIG_USB_CONFIGFS_F_HID=y",
+        "CONFIG_UHID=y",
+        "CONFIG_HIDRAW=y",
+    ],
+    "rtl8812au_driver": [
+        "CONFIG_RTL8812AU=m",
+    ],
+}
+
+# Settings every variant of a build matrix must share, since they build from one checkout
+MATRIX_SHARED_KEYS = (
+    "kernel_repo", "kernel_branch", "nethunter_patches_repo", "nethunter_patches_branch",
+    "nethunter_patches_dir_relative", "git_patch_level", "kernel_arch", "kernel_cross_compile",
+    "output_dir", "wsl_distro_name", "kernel_sparse_checkout", "kernel_sparse_exclude",
+)
+
+# Number of trailing output lines kept in memory for streamed commands
+OUTPUT_RING_SIZE = 200
+
+# Minimum number of seconds between two streamed PROGRESS updates
+PROGRESS_MIN_INTERVAL = 0.5
+
+# Name of the file recording the inputs an out-of-tree build directory was made from
+BUILD_FINGERPRINT_FILE = ".customizer_fingerprint.json"
+# Copy of the .config of the last successful compile in an incremental build directory
+BUILT_CONFIG_FILE = ".customizer_built_config"
+# Rough number of objects in a module-only build, for its progress range
+MODULE_ESTIMATED_OBJECTS = 200
+
+# Directory under output_dir that receives the images, DTBs, modules and .config of a build
+ARTIFACTS_DIR_NAME = "artifacts"
+ARTIFACT_MANIFEST_FILE = "manifest.json"
+SIZE_UNITS = {"K": 1, "M": 1024, "G": 1024 ** 2, "T": 1024 ** 3}
+
+# Directory inside output_dir holding the customizer's own caches and state
+STATE_DIR_NAME = ".kernel_customizer"
+
+# Pipeline checkpoint in output_dir, read by --resume
+CHECKPOINT_FILE = "checkpoint.json"
+# Config keys and earlier stages whose values make up each stage's checkpoint fingerprint.
+# None stands for the whole config: any change invalidates the build.
+CHECKPOINT_STAGE_INPUTS = {
+    "setup_env": (("wsl_distro_name", "wsl_backend", "kernel_cross_compile"), ()),
+    "clone_kernel": (("kernel_repo", "kernel_branch", "output_dir", "build_placement", "native_build_dir",
+                      "git_mirror_cache", "git_mirror_dir", "kernel_sparse_checkout", "kernel_sparse_exclude",
+                      "kernel_arch"), ()),
+    "clone_nethunter": (("nethunter_patches_repo", "nethunter_patches_branch", "output_dir", "build_placement",
+                         "native_build_dir", "git_mirror_cache", "git_mirror_dir"), ()),
+    "config_tweaks": (("codename", "defconfig_filename_template", "features", "custom_kernel_configs"), ("clone_kernel",)),
+    "patches": (("nethunter_patches_dir_relative", "git_patch_level"), ("clone_nethunter", "config_tweaks")),
+    "build": (None, ("setup_env", "patches")),
+}
+# Stages that modify the kernel checkout; re-running one means starting both from a clean tree
+CHECKPOINT_TREE_STAGES = ("config_tweaks", "patches")
+
+# Shell function applying one patch of a series and reporting the outcome on stdout.
+# Arguments: name, path, cached status hint, git patch level.
+APPLY_PATCH_FUNCTION = r"""
+kc_patch() {
+  if [ "$3" = conflict ]; then echo "PATCH_RESULT skipped $1"; return; fi
+  if [ "$3" = already_applied ] && git apply -p"$4" -R --check "$2" 2>/dev/null; then
+    echo "PATCH_RESULT already_applied $1"; return
+  fi
+  if out=$(git apply -p"$4" --verbose "$2" 2>&1); then
+    echo "PATCH_RESULT applied $1"
+  elif git apply -p"$4" -R --check "$2" 2>/dev/null; then
+    echo "PATCH_RESULT already_applied $1"
+  else
+    echo "PATCH_RESULT conflict $1"
+    printf '%s\n' "$out" | sed 's/^/PATCH_DETAIL /'
+  fi
 }
+"""
+
+# kbuild prints one of these per produced object, e.g. "  CC      kernel/fork.o"
+KBUILD_OBJECT_LINE = re.compile(r"^\s+(CC|LD|AS|AR)(\s\[M\])?\s+\S")
+
+_output_lock = threading.Lock()
+# Highest percentage reported so far; a build replaces it through reset_progress()
+_progress_state = contextvars.ContextVar("progress_state", default={"last": 0})
+# Receives typed events instead of stdout lines while a --serve job runs
+_event_sink = contextvars.ContextVar("event_sink", default=None)
+
+def emit_line(line: str):
+    """Write one protocol line to stdout without interleaving with other threads."""
+    with _output_lock:
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+def emit_event(event_type: str, line: str, **fields):
+    """Report an event as a typed dict to the active sink, or as a protocol line on stdout."""
+    sink = _event_sink.get()
+    if sink is None:
+        emit_line(line)
+    else:
+        sink({"type": event_type, **fields})
+
+def reset_progress():
+    """Start a new build's progress bar from zero."""
+    _progress_state.set({"last": 0})
 
 def progress_update(percentage, message):
     """Send progress updates that can be parsed by the web interface"""
-    print(f"PROGRESS: {percentage}% - {message}", flush=True)
+    state = _progress_state.get()
+    # Stages running in parallel report from different parts of the bar; never move it backwards
+    with _output_lock:
+        percentage = max(percentage, state["last"])
+        state["last"] = percentage
+    emit_event("progress", f"PROGRESS: {percentage}% - {message}", percent=percentage, message=message)
     logger.info(f"Progress: {percentage}% - {message}")
 
 def step_update(step_name):
     """Send step updates that can be parsed by the web interface"""
-    print(f"STEP: {step_name}", flush=True)
+    emit_event("step", f"STEP: {step_name}", step=step_name)
     logger.info(f"Current step: {step_name}")
 
+def ccache_update(stats: dict):
+    """Send compiler cache statistics that can be parsed by the web interface"""
+    fields = " ".join(f"{key}={value}" for key, value in stats.items())
+    emit_event("ccache", f"CCACHE: {fields}", **stats)
+    logger.info(f"Compiler cache: {fields}")
+
+def distributed_update(counts: dict):
+    """Send per-host distributed compile counts that can be parsed by the web interface"""
+    fields = " ".join(f"{host}={count}" for host, count in counts.items())
+    emit_event("distributed", f"DISTRIBUTED: {fields}", hosts=counts)
+    logger.info(f"Distributed compile jobs per host: {fields}")
+
+class OutputProgress:
+    """Turns kbuild output lines into throttled PROGRESS updates for a range of the bar."""
+
+    def __init__(self, start: int, end: int, estimated_total: int, message: str):
+        self.start = start
+        self.end = end
+        self.estimated_total = max(int(estimated_total), 1)
+        self.message = message
+        self.count = 0
+        self._last_percentage = None
+        self._last_emit = 0.0
+
+    def feed(self, line: str):
+        if not KBUILD_OBJECT_LINE.match(line):
+            return
+        self.count += 1
+        now = time.monotonic()
+        if now - self._last_emit < PROGRESS_MIN_INTERVAL:
+            return
+
+        # Never report the end of the range before the command actually finishes
+        fraction = min(self.count / self.estimated_total, 1.0)
+        percentage = min(self.start + int(fraction * (self.end - self.start)), self.end - 1)
+        if percentage != self._last_percentage:
+            progress_update(percentage, f"{self.message} ({self.count}/~{self.estimated_total} objects)")
+            self._last_percentage = percentage
+        self._last_emit = now
+
 def windows_to_wsl_path(windows_path: Path) -> str:
     """Converts an absolute Windows path to its WSL equivalent."""
     abs_windows_path = windows_path.resolve()
@@ -81,30 +407,494 @@ def windows_to_wsl_path(windows_path: Path) -> str:
 
     raise ValueError(f"Path format not recognized or not absolute for WSL conversion: {windows_path}")
 
-def run_command(command: str, shell: bool = False, wsl: bool = False, wsl_distro: str = None):
-    """Run a shell command, optionally in a specific WSL distribution."""
+class StageMetrics:
+    """Timing and resource counters collected while one pipeline stage runs.
+
+    peak_rss_kb is the largest peak RSS of a single command run in the stage,
+    including its child processes. It is measured with GNU time inside the shell
+    session and stays None where that is unavailable or for one-off processes.
+    """
+
+    def __init__(self, name: str, parent: str = None):
+        self.name = name
+        self.parent = parent
+        self.status = "running"
+        self.wall_seconds = 0.0
+        self.child_cpu_seconds = 0.0
+        self.peak_rss_kb = None
+        self.commands = 0
+        self.process_spawns = 0
+        self.output_bytes = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "stage": self.name,
+            "parent": self.parent,
+            "status": self.status,
+            "wall_seconds": self.wall_seconds,
+            "child_cpu_seconds": round(self.child_cpu_seconds, 3),
+            "peak_rss_kb": self.peak_rss_kb,
+            "commands": self.commands,
+            "process_spawns": self.process_spawns,
+            "output_bytes": self.output_bytes,
+        }
+
+class BuildReport:
+    """All stage metrics of one build, written out as build_report.json."""
+
+    def __init__(self):
+        self.started_at = datetime.datetime.now(datetime.timezone.utc)
+        self.started = time.monotonic()
+        self.stages = []
+
+    def as_dict(self) -> dict:
+        top_level = [stage for stage in self.stages if stage.parent is None]
+        return {
+            "started_at": self.started_at.isoformat(),
+            "wall_seconds": round(time.monotonic() - self.started, 3),
+            # The Python process alone, over its whole lifetime; commands are in the stages
+            "customizer_peak_rss_kb": customizer_peak_rss_kb(),
+            "totals": {
+                key: round(sum(getattr(stage, key) for stage in top_level), 3)
+                for key in ("child_cpu_seconds", "commands", "process_spawns", "output_bytes")
+            },
+            "stages": [stage.as_dict() for stage in self.stages],
+        }
+
+_metrics_lock = threading.Lock()
+_active_stages = contextvars.ContextVar("active_stages", default=())
+_build_report = contextvars.ContextVar("build_report", default=None)
+
+def record_metrics(commands: int = 0, process_spawns: int = 0, output_bytes: int = 0, cpu_seconds: float = 0.0,
+                   peak_rss_kb: int = None):
+    """Add command counters to every stage active in the calling context."""
+    with _metrics_lock:
+        for metrics in _active_stages.get():
+            metrics.commands += commands
+            metrics.process_spawns += process_spawns
+            metrics.output_bytes += output_bytes
+            metrics.child_cpu_seconds += cpu_seconds
+            if peak_rss_kb is not None:
+                metrics.peak_rss_kb = max(metrics.peak_rss_kb or 0, peak_rss_kb)
+
+def children_cpu_seconds() -> float:
+    """CPU time used by reaped child processes of this process (0 where unsupported)."""
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def customizer_peak_rss_kb():
+    """Lifetime peak resident set size of the customizer's own Python process, if known."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+@contextlib.contextmanager
+def instrument_stage(name: str):
+    """Collect StageMetrics for the enclosed code and report them as a METRIC: line.
+
+    Stages nest: commands run inside an inner stage also count towards the outer
+    ones. Child CPU time comes from the shell session's own accounting, or from
+    getrusage for one-off processes, and is approximate while stages overlap.
+    """
+    active = _active_stages.get()
+    metrics = StageMetrics(name, active[-1].name if active else None)
+    token = _active_stages.set(active + (metrics,))
+    started = time.monotonic()
+    try:
+        yield metrics
+        metrics.status = "completed"
+    except BaseException:
+        metrics.status = "failed"
+        raise
+    finally:
+        _active_stages.reset(token)
+        metrics.wall_seconds = round(time.monotonic() - started, 3)
+        report = _build_report.get()
+        if report is not None:
+            with _metrics_lock:
+                report.stages.append(metrics)
+        emit_event("metric", f"METRIC: {json.dumps(metrics.as_dict(), sort_keys=True)}", **metrics.as_dict())
+
+@contextlib.contextmanager
+def build_report(config: dict):
+    """Collect the metrics of every stage run inside and write build_report.json."""
+    report = BuildReport()
+    token = _build_report.set(report)
+    try:
+        yield report
+    finally:
+        _build_report.reset(token)
+        summary = report.as_dict()
+        total = {"stage": "total", "wall_seconds": summary["wall_seconds"], **summary["totals"]}
+        emit_event("metric", f"METRIC: {json.dumps(total, sort_keys=True)}", **total)
+        try:
+            report_path = Path(config["output_dir"]).expanduser().resolve() / "build_report.json"
+            report_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(report_path, "w", encoding="utf-8") as f:
+                json.dump(summary, f, indent=2)
+            logger.info(f"Build report written to {report_path}")
+        except OSError as e:
+            logger.warning(f"Could not write build report: {e}")
+
+@contextlib.contextmanager
+def build_log(config: dict, build_id: str = None):
+    """Write the records of the enclosed build to their own file in <output_dir>/logs.
+
+    Files rotate at log_max_bytes into up to log_backup_count gzipped parts, and
+    only the newest log_keep_builds build logs are kept. Each line is a JSON
+    object with the stage and command_id the record was logged under.
+    """
+    build_id = build_id or f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    log_dir = Path(config["output_dir"]).expanduser().resolve() / "logs"
+    log_path = log_dir / f"build-{build_id}.log"
+    try:
+        log_dir.mkdir(parents=True, exist_ok=True)
+        previous_logs = sorted(log_dir.glob("build-*.log"), key=lambda path: path.stat().st_mtime, reverse=True)
+        for old_log in previous_logs[max(int(config.get("log_keep_builds", 20)) - 1, 0):]:
+            for part in log_dir.glob(f"{old_log.name}*"):
+                part.unlink()
+        handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=int(config.get("log_max_bytes", 10 * 1024 * 1024)),
+                                                       backupCount=int(config.get("log_backup_count", 5)),
+                                                       encoding="utf-8", delay=True)
+    except OSError as e:
+        logger.warning(f"Could not set up the build log in {log_dir}: {e}")
+        yield None
+        return
+
+    handler.namer = lambda name: name + ".gz"
+    handler.rotator = gzip_rotator
+    handler.setFormatter(JsonLogFormatter())
+    handler.setLevel(config.get("log_level", "DEBUG"))
+    _build_log_router.build_handlers[build_id] = handler
+    # Debug records are only created while some build log wants them
+    if handler.level < logging.INFO:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    token = _build_id.set(build_id)
+    logger.info(f"Logging this build to {log_path}")
+    try:
+        yield build_id
+    finally:
+        _build_id.reset(token)
+        close_record = logging.LogRecord(__name__, logging.DEBUG, __file__, 0, "", None, None)
+        close_record.close_build_log = build_id
+        _log_queue.put(close_record)
+
+def submit_in_context(executor: ThreadPoolExecutor, func, *args):
+    """Submit func to an executor so it runs with the caller's context variables."""
+    return executor.submit(contextvars.copy_context().run, func, *args)
+
+_shell_backend = "wsl"
+_persistent_sessions = True
+
+def command_summary(command: str) -> str:
+    """Shorten multi-line scripts to their first line for log output."""
+    lines = command.strip().splitlines()
+    if len(lines) <= 1:
+        return command
+    return f"{lines[0].strip()} ... (+{len(lines) - 1} lines)"
+
+def configure_shell(config: dict):
+    """Select the shell backend and session mode used by run_command(wsl=True)."""
+    global _shell_backend, _persistent_sessions
+    backend = config.get("wsl_backend", "wsl")
+    backend = SHELL_BACKEND_ALIASES.get(backend, backend)
+    if backend not in SHELL_BACKENDS:
+        raise SystemExit(f"Unknown wsl_backend '{backend}'. Expected one of: {', '.join(SHELL_BACKENDS)}")
+    _shell_backend = backend
+    _persistent_sessions = config.get("wsl_persistent_session", True)
+    logger.info(f"Using {backend} shell backend ({'persistent session' if _persistent_sessions else 'one process per command'})")
+
+def shell_argv(wsl_distro: str, command: str = None) -> list:
+    """Return the argv for a bash in the selected backend, running command or reading stdin."""
+    base = ["wsl", "-d", wsl_distro, "--", "bash"] if _shell_backend == "wsl" else ["bash"]
+    if command is None:
+        return base + ["--noprofile", "--norc", "-s"]
+    return base + ["-c", command]
+
+# Sent to every persistent shell once. kc_exec runs one command: under GNU time, which
+# writes the peak RSS of the command and its children to a file, or else in a subshell.
+# GNU time puts a "Command exited with non-zero status" line before the value on failure.
+SESSION_EXEC_FUNCTION = r"""
+KC_RSS_FILE=$(mktemp 2>/dev/null)
+KC_TIME=
+KC_TIME_PROBED=
+trap 'rm -f "$KC_RSS_FILE"' EXIT
+kc_exec() {
+  # Probed once it exists: the environment setup may install it after the session started
+  if [ -z "$KC_TIME_PROBED" ] && [ -x /usr/bin/time ]; then
+    KC_TIME_PROBED=1
+    if [ -n "$KC_RSS_FILE" ] && /usr/bin/time -f %M -o "$KC_RSS_FILE" true 2>/dev/null; then KC_TIME=/usr/bin/time; fi
+  fi
+  if [ -n "$KC_TIME" ]; then : > "$KC_RSS_FILE"; "$KC_TIME" -f %M -o "$KC_RSS_FILE" bash -c "$1"; else ( eval "$1" ); fi
+}
+kc_peak_rss() { [ -n "$KC_TIME" ] && tail -n 1 "$KC_RSS_FILE"; }
+"""
+
+class ShellSessionError(RuntimeError):
+    """Raised when a persistent shell exits while a command is still running."""
+
+class ShellSession:
+    """A long-lived bash process that runs commands sent over its stdin.
+
+    Every command is run through eval in its own subshell, so syntax errors,
+    `cd` and `exit` behave as they would under `bash -c`. Completion is framed by a
+    random marker printed with the exit code on stdout, and on stderr by the
+    `time` keyword, whose TIMEFORMAT also reports the command's CPU seconds.
+    Where GNU time is installed, commands run under it instead, as `bash -c`, so
+    the marker line also carries the peak RSS of the command and its children.
+    """
+
+    def __init__(self, argv: list):
+        self.argv = argv
+        self.marker = f"__KC_DONE_{uuid.uuid4().hex}__"
+        self.process = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                        text=True, encoding='utf-8', errors='replace', bufsize=1)
+        # Text-mode pipes write \r\n on Windows, which bash reads as part of every command
+        self.process.stdin = io.TextIOWrapper(self.process.stdin.detach(), encoding='utf-8',
+                                              newline="\n", write_through=True)
+        self._stderr_lines = queue.Queue()
+        self._stderr_thread = threading.Thread(target=self._pump_stderr, daemon=True)
+        self._stderr_thread.start()
+        self.process.stdin.write(f"TIMEFORMAT='{self.marker} %3U %3S'\n")
+        self.process.stdin.write(SESSION_EXEC_FUNCTION)
+
+    def _pump_stderr(self):
+        for line in self.process.stderr:
+            self._stderr_lines.put(line)
+        self._stderr_lines.put(None)
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def run(self, command: str, input: str = None, merge_stderr: bool = False, on_line=None):
+        """Run one command and return (returncode, stdout, stderr, cpu_seconds, peak_rss_kb).
+
+        on_line receives stdout lines as they arrive, in which case they are not
+        collected. merge_stderr sends the command's stderr to stdout.
+        """
+        stdin_redirect = "</dev/null"
+        heredoc = ""
+        if input is not None:
+            delimiter = f"__KC_INPUT_{uuid.uuid4().hex}__"
+            stdin_redirect = f"<<'{delimiter}'"
+            heredoc = f"{input}{'' if input.endswith(chr(10)) or not input else chr(10)}{delimiter}\n"
+        stderr_redirect = " 2>&1" if merge_stderr else ""
+
+        # Braces keep the redirections off `time`, whose report must reach the real stderr
+        script = (f"time {{ kc_exec {shlex.quote(command)}{stderr_redirect} {stdin_redirect}; }}; "
+                  f"printf '%s %d %s\\n' '{self.marker}' $? \"$(kc_peak_rss)\"\n{heredoc}")
+        try:
+            self.process.stdin.write(script)
+            self.process.stdin.flush()
+        except OSError as e:
+            raise ShellSessionError(f"Shell session {self.argv} is not accepting commands: {e}")
+
+        stdout_lines = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise ShellSessionError(f"Shell session {self.argv} exited unexpectedly")
+            position = line.find(self.marker)
+            if position >= 0:
+                status = line[position + len(self.marker):].split()
+                returncode = int(status[0])
+                peak_rss_kb = int(status[1]) if len(status) > 1 and status[1].isdigit() else None
+                line = line[:position]
+            if line and on_line is None:
+                stdout_lines.append(line)
+            elif line:
+                on_line(line.rstrip("\n"))
+            if position >= 0:
+                break
+
+        stderr_lines = []
+        while True:
+            line = self._stderr_lines.get()
+            if line is None:
+                raise ShellSessionError(f"Shell session {self.argv} exited unexpectedly")
+            position = line.find(self.marker)
+            if position >= 0:
+                stderr_lines.append(line[:position])
+                times = line[position + len(self.marker):].replace(",", ".").split()
+                cpu_seconds = sum(float(value) for value in times)
+                break
+            stderr_lines.append(line)
+
+        return returncode, "".join(stdout_lines), "".join(stderr_lines), cpu_seconds, peak_rss_kb
+
+    def close(self):
+        if self.alive():
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+
+_session_lock = threading.Lock()
+_idle_sessions = {}
+
+def _acquire_session(wsl_distro: str) -> ShellSession:
+    """Take an idle session for the distribution or start a new one."""
+    argv = tuple(shell_argv(wsl_distro))
+    with _session_lock:
+        idle = _idle_sessions.setdefault(argv, [])
+        while idle:
+            session = idle.pop()
+            if session.alive():
+                return session
+    logger.debug(f"Starting persistent shell session: {' '.join(argv)}")
+    record_metrics(process_spawns=1)
+    return ShellSession(list(argv))
+
+def _release_session(session: ShellSession):
+    with _session_lock:
+        _idle_sessions.setdefault(tuple(session.argv), []).append(session)
+
+def close_sessions():
+    """Shut down all idle persistent shell sessions."""
+    with _session_lock:
+        sessions = [session for idle in _idle_sessions.values() for session in idle]
+        _idle_sessions.clear()
+    for session in sessions:
+        session.close()
+
+atexit.register(close_sessions)
+
+def _run_in_session(command: str, wsl_distro: str, stream: bool = False,
+                    progress: OutputProgress = None, input: str = None) -> str:
+    """run_command backend that sends the command to a persistent shell session."""
+    tail = deque(maxlen=OUTPUT_RING_SIZE)
+    streamed_bytes = 0
+
+    def on_line(line):
+        nonlocal streamed_bytes
+        streamed_bytes += len(line) + 1
+        tail.append(line)
+        logger.debug(line)
+        if progress:
+            progress.feed(line)
+
+    session = _acquire_session(wsl_distro)
+    try:
+        returncode, stdout, stderr, cpu_seconds, peak_rss_kb = session.run(
+            command, input=input, merge_stderr=stream, on_line=on_line if stream else None)
+    except BaseException:
+        # The session may be half-way through a command; never hand it out again
+        session.close()
+        raise
+    _release_session(session)
+    record_metrics(commands=1, output_bytes=streamed_bytes + len(stdout) + len(stderr), cpu_seconds=cpu_seconds,
+                   peak_rss_kb=peak_rss_kb)
+
+    output = "\n".join(tail) if stream else stdout
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command, output=output, stderr=stderr)
+
+    logger.info(f"Command executed successfully: {command_summary(command)}")
+    if not stream:
+        log_output_lines(stdout, "stdout")
+    log_output_lines(stderr, "stderr")
+    return output
+
+def _stream_command(command, shell: bool = False, progress: OutputProgress = None) -> str:
+    """Run a command while reading its output line by line.
+
+    Only the last OUTPUT_RING_SIZE lines are kept, so memory stays flat no matter
+    how much the command prints. stderr is merged into stdout to keep ordering.
+    """
+    tail = deque(maxlen=OUTPUT_RING_SIZE)
+    output_bytes = 0
+    cpu_before = children_cpu_seconds()
+    with subprocess.Popen(command, shell=shell, text=True, encoding='utf-8', errors='replace',
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1) as process:
+        for line in process.stdout:
+            output_bytes += len(line)
+            line = line.rstrip("\n")
+            tail.append(line)
+            logger.debug(line)
+            if progress:
+                progress.feed(line)
+        returncode = process.wait()
+    record_metrics(commands=1, process_spawns=1, output_bytes=output_bytes,
+                   cpu_seconds=children_cpu_seconds() - cpu_before)
+
+    output = "\n".join(tail)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command, output=output)
+    return output
+
+def log_output_lines(text: str, stream_name: str):
+    """Log captured command output one line per debug record."""
+    if text and logger.isEnabledFor(logging.DEBUG):
+        for line in text.rstrip("\n").splitlines():
+            logger.debug(f"[{stream_name}] {line}")
+
+def run_command(command: str, shell: bool = False, wsl: bool = False, wsl_distro: str = None,
+                stream: bool = False, progress: OutputProgress = None, input: str = None):
+    """Run a shell command, optionally in a specific WSL distribution.
+
+    With stream=True the output is read incrementally instead of being captured
+    in full, and only the tail of it is returned. input is written to the
+    command's stdin (not supported together with stream). Everything logged
+    while the command runs carries its command_id.
+    """
+    token = _command_id.set(f"c{next(_command_ids)}")
+    try:
+        return _execute_command(command, shell, wsl, wsl_distro, stream, progress, input)
+    finally:
+        _command_id.reset(token)
+
+def _execute_command(command: str, shell: bool, wsl: bool, wsl_distro: str,
+                     stream: bool, progress: OutputProgress, input: str):
     if wsl:
         if not wsl_distro:
             raise ValueError("wsl_distro must be specified if wsl=True")
         
-        # For complex commands, wrap with bash -c
-        if any(c in command for c in ['|', '&', ';', '<', '>', '(', ')', '$', '`', '\\', '"', "'", '*', '?', '#', '~', '=', '%']):
-            wsl_command = ["wsl", "-d", wsl_distro, "--", "bash", "-c", command]
-        else:
-            wsl_command = ["wsl", "-d", wsl_distro, "--", "bash", "-c", command]
-        
+        if _persistent_sessions:
+            logger.debug(f"Executing in shell session ({_shell_backend}/{wsl_distro}): {command_summary(command)}")
+            try:
+                return _run_in_session(command, wsl_distro, stream=stream, progress=progress, input=input)
+            except ShellSessionError as e:
+                logger.error(str(e))
+                raise subprocess.CalledProcessError(255, command, output=str(e))
+
+        wsl_command = shell_argv(wsl_distro, command)
         logger.debug(f"Executing WSL command: {' '.join(wsl_command)}")
-        result = subprocess.run(wsl_command, check=True, text=True, capture_output=True, encoding='utf-8')
+        process_command, process_shell = wsl_command, False
     else:
         logger.debug(f"Executing command: {command}")
-        result = subprocess.run(command, shell=shell, check=True, text=True, capture_output=True, encoding='utf-8')
+        process_command, process_shell = command, shell
 
-    logger.info(f"Command executed successfully: {command}")
-    if result.stdout:
-        logger.debug(f"Stdout:\n{result.stdout.strip()}")
-    if result.stderr:
-        logger.debug(f"Stderr:\n{result.stderr.strip()}")
-    return result.stdout
+    if stream:
+        output = _stream_command(process_command, shell=process_shell, progress=progress)
+        logger.info(f"Command executed successfully: {command_summary(command)}")
+        return output
+
+    cpu_before = children_cpu_seconds()
+    try:
+        # input goes in as bytes: text mode would write it with \r\n line endings on Windows
+        result = subprocess.run(process_command, shell=process_shell, check=True, capture_output=True,
+                                input=input.encode('utf-8') if input is not None else None)
+    except subprocess.CalledProcessError as e:
+        raise subprocess.CalledProcessError(e.returncode, e.cmd, output=_decode_output(e.output),
+                                            stderr=_decode_output(e.stderr))
+    finally:
+        record_metrics(commands=1, process_spawns=1, cpu_seconds=children_cpu_seconds() - cpu_before)
+    stdout, stderr = _decode_output(result.stdout), _decode_output(result.stderr)
+    record_metrics(output_bytes=len(stdout) + len(stderr))
+    logger.info(f"Command executed successfully: {command_summary(command)}")
+    log_output_lines(stdout, "stdout")
+    log_output_lines(stderr, "stderr")
+    return stdout
+
+def _decode_output(data: bytes) -> str:
+    """Decode captured process output the way text-mode pipes do, newlines included."""
+    if data is None:
+        return None
+    return data.decode('utf-8').replace("\r\n", "\n").replace("\r", "\n")
 
 def check_wsl_and_distro(distro_name: str):
     """Check if WSL is installed and the specified distribution is available."""
@@ -112,6 +902,16 @@ def check_wsl_and_distro(distro_name: str):
     progress_update(5, "Verifying WSL installation")
     
     logger.info("Checking WSL and distribution setup...")
+    if _shell_backend == "native":
+        logger.info("Native shell backend selected; skipping WSL installation checks.")
+        try:
+            run_command("echo 'Shell connectivity test'", wsl=True, wsl_distro=distro_name)
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Error starting the native shell: {e}")
+            raise SystemExit("Native shell check failed.")
+        progress_update(12, "Native shell connectivity verified")
+        return
+
     try:
         run_command("wsl --status", shell=True)
         logger.info("WSL is installed.")
@@ -139,34 +939,82 @@ def check_wsl_and_distro(distro_name: str):
         logger.error(f"Error interacting with WSL or {distro_name}: {e}")
         raise SystemExit(f"WSL or {distro_name} check failed.")
 
+# Toolchain checks of this process by backend and distro; a --serve worker shares them across jobs
+_verified_toolchains = {}
+
+def probe_toolchain(distro_name: str) -> list:
+    """Return the TOOLCHAIN_PACKAGES that are missing, using one batched shell query.
+
+    A package counts as present when dpkg reports it installed or, for systems
+    without dpkg, when its probe binary is on PATH.
+    """
+    packages = " ".join(TOOLCHAIN_PACKAGES)
+    binaries = " ".join(binary for binary in TOOLCHAIN_PACKAGES.values() if binary)
+    probe_cmd = (f"if command -v dpkg-query >/dev/null; then "
+                 f"dpkg-query -W -f='PKG ${{Package}} ${{db:Status-Abbrev}}\\n' {packages} 2>/dev/null; fi; "
+                 f"for b in {binaries}; do command -v \"$b\" >/dev/null && echo \"BIN $b\"; done; true")
+    output = run_command(probe_cmd, wsl=True, wsl_distro=distro_name)
+
+    installed_packages, found_binaries = set(), set()
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) >= 3 and fields[0] == "PKG" and fields[2].startswith("ii"):
+            installed_packages.add(fields[1].split(":")[0])
+        elif len(fields) == 2 and fields[0] == "BIN":
+            found_binaries.add(fields[1])
+
+    return [package for package, binary in TOOLCHAIN_PACKAGES.items()
+            if package not in installed_packages and binary not in found_binaries]
+
 def setup_wsl_environment(config: dict, skip_setup: bool = False):
-    """Set up the WSL environment with necessary tools."""
+    """Set up the WSL environment with necessary tools.
+
+    The toolchain is probed first and apt only runs for missing packages, in a
+    single transaction. A complete toolchain is remembered for toolchain_probe_ttl
+    seconds so repeated builds skip the probe as well.
+    """
     if skip_setup:
         logger.info("Skipping WSL environment setup as requested.")
         return
 
     step_update("Setting up WSL environment")
     distro_name = config["wsl_distro_name"]
-    progress_update(15, f"Installing build tools in {distro_name}")
-    
-    logger.info(f"Setting up WSL environment in {distro_name}...")
-    
-    commands = [
-        "sudo apt-get update -y",
-        "sudo apt-get install -y git python3 python3-pip bison flex gawk bc ccache device-tree-compiler libssl-dev",
-        "sudo apt-get install -y build-essential gcc-aarch64-linux-gnu",
-        "sudo apt-get install -y libncurses5-dev"
-    ]
-    
-    for i, cmd in enumerate(commands):
+    progress_update(15, f"Checking build tools in {distro_name}")
+
+    cache_path = state_dir(config) / "toolchain_probe.json"
+    cache_key = f"{_shell_backend}:{distro_name}"
+    wanted = sorted(TOOLCHAIN_PACKAGES)
+    ttl = int(config.get("toolchain_probe_ttl", 86400))
+    cached = _verified_toolchains.get(cache_key) or load_state_file(cache_path).get(cache_key, {})
+    if (ttl > 0 and cached.get("packages") == wanted
+            and time.time() - cached.get("checked_at", 0) < ttl):
+        logger.info(f"Build tools in {distro_name} were verified recently; skipping the probe.")
+        progress_update(20, "Build tools already installed")
+        return
+
+    logger.info(f"Probing build tools in {distro_name}...")
+    missing = probe_toolchain(distro_name)
+    if missing:
+        progress_update(17, f"Installing {len(missing)} missing packages")
+        install_cmd = f"sudo apt-get update -y && sudo apt-get install -y {' '.join(missing)}"
         try:
-            logger.info(f"Running in WSL: {cmd}")
-            run_command(cmd, wsl=True, wsl_distro=distro_name)
-            progress_update(15 + (i + 1) * 2, f"Installing packages ({i + 1}/{len(commands)})")
+            logger.info(f"Running in WSL: {install_cmd}")
+            run_command(install_cmd, wsl=True, wsl_distro=distro_name)
         except subprocess.CalledProcessError as e:
-            logger.error(f"Failed to execute in WSL: {cmd}. Error: {e}")
+            logger.error(f"Failed to execute in WSL: {install_cmd}. Error: {e}")
             raise SystemExit("WSL environment setup failed.")
 
+        still_missing = probe_toolchain(distro_name)
+        if still_missing:
+            raise SystemExit(f"WSL environment setup failed; still missing: {', '.join(still_missing)}")
+    else:
+        logger.info("All build tools are already installed.")
+
+    cache = load_state_file(cache_path)
+    cache[cache_key] = _verified_toolchains[cache_key] = {"packages": wanted, "checked_at": time.time()}
+    save_state_file(cache_path, cache)
+    progress_update(20, "Build tools ready")
+
 def load_config(config_path_str: str) -> dict:
     """Load the kernel configuration file."""
     config_path = Path(config_path_str)
@@ -178,7 +1026,7 @@ def load_config(config_path_str: str) -> dict:
     try:
         with open(config_path, "r", encoding="utf-8") as f:
             config_data = json.load(f)
-            final_config = DEFAULT_CONFIG.copy()
+            final_config = copy.deepcopy(DEFAULT_CONFIG)
             final_config.update(config_data)
             return final_config
     except json.JSONDecodeError as e:
@@ -188,50 +1036,276 @@ def load_config(config_path_str: str) -> dict:
         logger.error(f"Unable to read config file {config_path}: {e}")
         raise SystemExit(f"Cannot read configuration file: {e}")
 
-def clone_repositories(config: dict, skip_clone: bool = False):
-    """Clone kernel and NetHunter patches repositories into WSL."""
-    if skip_clone:
-        logger.info("Skipping repository cloning as requested.")
-        return None, None
+def host_to_shell_path(host_path: Path) -> str:
+    """Return the path under which the selected shell backend sees a path of this machine."""
+    if _shell_backend == "native":
+        return str(host_path.resolve())
+    return windows_to_wsl_path(host_path)
 
-    step_update("Cloning repositories")
+def prepare_output_dir_wsl(config: dict) -> str:
+    """Create output_dir and return its WSL path."""
     output_dir_windows = Path(config["output_dir"]).expanduser().resolve()
     output_dir_windows.mkdir(parents=True, exist_ok=True)
-    output_dir_wsl = windows_to_wsl_path(output_dir_windows)
+    output_dir_wsl = host_to_shell_path(output_dir_windows)
+    run_command(f"mkdir -p '{output_dir_wsl}'", wsl=True, wsl_distro=config["wsl_distro_name"])
+    return output_dir_wsl
+
+def prepare_workspace_wsl(config: dict) -> str:
+    """Create and return the WSL directory that holds the checkouts and object trees.
+
+    With build_placement "native" every output_dir gets its own workspace under
+    native_build_dir, named after the codename and a hash of output_dir, so the
+    compile never touches the slow /mnt/<drive> bridge.
+    """
+    placement = config.get("build_placement", "output_dir")
+    if placement not in BUILD_PLACEMENTS:
+        raise SystemExit(f"Unknown build_placement '{placement}'. Expected one of: {', '.join(BUILD_PLACEMENTS)}")
+    if placement == "output_dir":
+        return prepare_output_dir_wsl(config)
+
+    output_dir_windows = Path(config["output_dir"]).expanduser().resolve()
+    workspace_name = f"{config['codename']}-{hashlib.sha256(str(output_dir_windows).encode('utf-8')).hexdigest()[:12]}"
+    workspace = f"{config['native_build_dir'].rstrip('/')}/{workspace_name}"
+    # Commands quote paths in single quotes, so ~ has to be resolved here
+    workspace_wsl = run_command(f"mkdir -p {wsl_home_path(workspace)} && cd {wsl_home_path(workspace)} && pwd",
+                                wsl=True, wsl_distro=config["wsl_distro_name"]).strip()
+    logger.info(f"Building in native workspace {workspace_wsl}")
+    return workspace_wsl
+
+def sparse_checkout_script(target_wsl_path: str, config: dict, sparse: bool) -> str:
+    """Return the shell commands that put a checkout into, or out of, sparse mode.
+
+    The cone holds every top-level directory except arch and kernel_sparse_exclude,
+    plus the kernel_arch directories. Excluded directories that an included Kconfig
+    file sources are added back, since kconfig cannot run without them.
+    """
+    if not sparse:
+        return (f"if [ \"$(git -C '{target_wsl_path}' config core.sparseCheckout)\" = true ]; then "
+                f"git -C '{target_wsl_path}' sparse-checkout disable; fi")
+
+    arch = config.get("kernel_arch", "arm64")
+    arch_dirs = " ".join(shlex.quote(path) for path in SPARSE_ARCH_DIRS.get(arch, (f"arch/{arch}",)))
+    excluded = "|".join(re.escape(name) for name in ["arch", *config.get("kernel_sparse_exclude", [])])
+    return (
+        f"cd '{target_wsl_path}' && "
+        f"git sparse-checkout set --cone $(git ls-tree -d --name-only HEAD | grep -vxE {shlex.quote(excluded)}) {arch_dirs} && "
+        f"if [ \"$kc_fresh\" = 1 ]; then git checkout -q -f; fi && "
+        f"kc_extra=$(grep -rhE --include='Kconfig*' '^[[:space:]]*source[[:space:]]' . | "
+        f"sed -nE 's/^[[:space:]]*source[[:space:]]+\"?([^\"[:space:]]+).*/\\1/p' | {SPARSE_CONE_DIRS_AWK} | "
+        f"while read -r dir; do [ -e \"$dir\" ] || ! git cat-file -e \"HEAD:$dir\" 2>/dev/null || echo \"$dir\"; done) && "
+        f"if [ -n \"$kc_extra\" ]; then echo Widening sparse checkout for Kconfig: $kc_extra && git sparse-checkout add $kc_extra; fi"
+    )
+
+def clone_or_update_repository(repo_url: str, branch: str, target_wsl_path: str, label: str, config: dict,
+                               sparse: bool = None):
+    """Shallow-clone a repository into WSL, or pull it if it is already there.
+
+    With sparse True the clone is partial and sparse (see sparse_checkout_script):
+    blobs are only downloaded for the files inside the cone. None leaves the
+    checkout mode alone.
+    """
+    logger.info(f"Cloning {label} repository to {target_wsl_path}")
+    clone_args = " --filter=blob:none --sparse" if sparse else ""
+    clone_cmd = f"if [ ! -d '{target_wsl_path}/.git' ]; then git clone --depth 1{clone_args} -b '{branch}' '{repo_url}' '{target_wsl_path}'; else echo '{label} directory exists, updating...'; cd '{target_wsl_path}' && git pull; fi"
+    if sparse is not None:
+        clone_cmd = f"{{ {clone_cmd}; }} && {sparse_checkout_script(target_wsl_path, config, sparse)}"
+    run_command(clone_cmd, wsl=True, wsl_distro=config["wsl_distro_name"])
+
+def mirror_wsl_path(config: dict, repo_url: str) -> str:
+    """Return the quoted WSL path of the bare mirror caching repo_url."""
+    url_hash = hashlib.sha256(repo_url.encode("utf-8")).hexdigest()[:16]
+    return wsl_home_path(f"{config['git_mirror_dir'].rstrip('/')}/{url_hash}.git")
+
+def checkout_from_mirror(repo_url: str, branch: str, target_wsl_path: str, label: str, config: dict,
+                         sparse: bool = None):
+    """Check out a branch as a worktree of the shared bare mirror for repo_url.
+
+    The network is only used when the branch is missing from the mirror or
+    git_mirror_refresh is set, so switching branches or output directories is a
+    local operation. Mirror access is serialised with flock. When the branch tip
+    moved, local changes in the worktree are discarded: tweaks and patches are
+    re-applied by the later stages anyway. With sparse True, branches are fetched
+    without blobs and new worktrees are populated only after the sparse cone is set.
+    """
     distro_name = config["wsl_distro_name"]
+    mirror = mirror_wsl_path(config, repo_url)
+    ref = shlex.quote(f"refs/heads/{branch}")
+    depth = int(config.get("git_mirror_depth", 1))
+    depth_arg = f" --depth {depth}" if depth > 0 else ""
+    refresh = "1" if config.get("git_mirror_refresh", False) else "0"
+    fetch_args = f"{depth_arg} --filter=blob:none" if sparse else depth_arg
+    add_args = " --no-checkout" if sparse else ""
+
+    logger.info(f"Checking out {label} branch {branch} from mirror {mirror} to {target_wsl_path}")
+    mirror_cmd = (
+        f"mkdir -p \"$(dirname {mirror})\" && ( flock 9 && "
+        f"if [ ! -d {mirror} ]; then git init -q --bare {mirror} && git -C {mirror} remote add origin {shlex.quote(repo_url)}; fi && "
+        f"if [ {refresh} = 1 ] || ! git -C {mirror} rev-parse -q --verify {ref}^{{commit}} >/dev/null; then "
+        f"echo 'Fetching {branch} into mirror...' && git -C {mirror} fetch{fetch_args} origin +{ref}:{ref}; fi && "
+        f"git -C {mirror} worktree prune "
+        f") 9>{mirror}.lock && "
+        f"if [ -d '{target_wsl_path}/.git' ]; then echo '{label} directory is a standalone clone, updating...'; cd '{target_wsl_path}' && git pull; "
+        f"elif [ -f '{target_wsl_path}/.git' ]; then cd '{target_wsl_path}' && "
+        f"if [ \"$(git rev-parse HEAD)\" != \"$(git rev-parse {ref})\" ]; then "
+        f"echo 'Branch moved, resetting {label} worktree...' && git checkout -q -f --detach {ref} && git clean -q -fd; fi; "
+        f"else git -C {mirror} worktree add -q{add_args} --detach '{target_wsl_path}' {ref} && kc_fresh=1; fi"
+    )
+    if sparse is not None:
+        mirror_cmd = f"kc_fresh=0; {mirror_cmd} && {sparse_checkout_script(target_wsl_path, config, sparse)}"
+    run_command(mirror_cmd, wsl=True, wsl_distro=distro_name)
 
-    kernel_wsl_path_str = f"{output_dir_wsl}/kernel_source"
-    nethunter_wsl_path_str = f"{output_dir_wsl}/nethunter_patches_source"
+def fetch_repository(repo_url: str, branch: str, target_wsl_path: str, label: str, config: dict,
+                     sparse: bool = None):
+    """Put the branch of repo_url at target_wsl_path, through the mirror cache if enabled."""
+    if config.get("git_mirror_cache", False):
+        checkout_from_mirror(repo_url, branch, target_wsl_path, label, config, sparse)
+    else:
+        clone_or_update_repository(repo_url, branch, target_wsl_path, label, config, sparse)
 
-    progress_update(25, "Creating build directories")
-    run_command(f"mkdir -p '{output_dir_wsl}'", wsl=True, wsl_distro=distro_name)
+def clone_kernel_repository(config: dict, skip_clone: bool = False):
+    """Clone the kernel repository into WSL and return its WSL path."""
+    if skip_clone:
+        logger.info("Skipping kernel repository cloning as requested.")
+        return None
 
-    # Clone kernel repository
+    step_update("Cloning kernel repository")
     progress_update(30, "Cloning kernel repository")
-    logger.info(f"Cloning kernel repository to {kernel_wsl_path_str}")
-    kernel_repo_url = config["kernel_repo"]
-    kernel_branch = config["kernel_branch"]
-    
-    kernel_clone_cmd = f"if [ ! -d '{kernel_wsl_path_str}/.git' ]; then git clone --depth 1 -b '{kernel_branch}' '{kernel_repo_url}' '{kernel_wsl_path_str}'; else echo 'Kernel directory exists, updating...'; cd '{kernel_wsl_path_str}' && git pull; fi"
-    run_command(kernel_clone_cmd, wsl=True, wsl_distro=distro_name)
+    kernel_wsl_path_str = f"{prepare_workspace_wsl(config)}/kernel_source"
+    fetch_repository(config["kernel_repo"], config["kernel_branch"], kernel_wsl_path_str, "Kernel", config,
+                     bool(config.get("kernel_sparse_checkout", False)))
+    progress_update(40, "Kernel repository ready")
+    return kernel_wsl_path_str
+
+def clone_nethunter_repository(config: dict, skip_clone: bool = False):
+    """Clone the NetHunter patches repository into WSL and return its WSL path."""
+    if skip_clone:
+        logger.info("Skipping NetHunter repository cloning as requested.")
+        return None
 
-    # Clone NetHunter patches repository
+    step_update("Cloning NetHunter patches")
     progress_update(35, "Cloning NetHunter patches")
-    logger.info(f"Cloning NetHunter patches repository to {nethunter_wsl_path_str}")
-    nethunter_repo_url = config["nethunter_patches_repo"]
-    nethunter_branch = config["nethunter_patches_branch"]
-    
-    nethunter_clone_cmd = f"if [ ! -d '{nethunter_wsl_path_str}/.git' ]; then git clone --depth 1 -b '{nethunter_branch}' '{nethunter_repo_url}' '{nethunter_wsl_path_str}'; else echo 'NetHunter patches directory exists, updating...'; cd '{nethunter_wsl_path_str}' && git pull; fi"
-    run_command(nethunter_clone_cmd, wsl=True, wsl_distro=distro_name)
-    
+    nethunter_wsl_path_str = f"{prepare_workspace_wsl(config)}/nethunter_patches_source"
+    fetch_repository(config["nethunter_patches_repo"], config["nethunter_patches_branch"],
+                     nethunter_wsl_path_str, "NetHunter patches", config)
+    progress_update(40, "NetHunter patches repository ready")
+    return nethunter_wsl_path_str
+
+def clone_repositories(config: dict, skip_clone: bool = False):
+    """Clone kernel and NetHunter patches repositories into WSL concurrently."""
+    if skip_clone:
+        logger.info("Skipping repository cloning as requested.")
+        return None, None
+
+    step_update("Cloning repositories")
+    progress_update(25, "Creating build directories")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        kernel_future = submit_in_context(executor, clone_kernel_repository, config)
+        nethunter_future = submit_in_context(executor, clone_nethunter_repository, config)
+        kernel_wsl_path_str, nethunter_wsl_path_str = kernel_future.result(), nethunter_future.result()
+
     progress_update(40, "Repository cloning completed")
     return kernel_wsl_path_str, nethunter_wsl_path_str
 
+class Defconfig:
+    """Ordered CONFIG_* index over the lines of a defconfig file.
+
+    Values are kept as written ("y", "m", "0x100", "\"str\"") and None stands for
+    "# CONFIG_X is not set". Lines that are not options are preserved untouched.
+    """
+
+    OPTION_LINE = re.compile(r"^(CONFIG_\w+)=(.*)$")
+    UNSET_LINE = re.compile(r"^#\s*(CONFIG_\w+) is not set\s*$")
+
+    def __init__(self, text: str = ""):
+        self.lines = text.splitlines()
+        self.index = {}
+        for line_number, line in enumerate(self.lines):
+            option = parse_config_option(line)
+            if option:
+                # Like Kconfig, the last assignment of a symbol wins
+                self.index[option[0]] = line_number
+        self.original = {key: self.get(key) for key in self.index}
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def get(self, key: str):
+        return parse_config_option(self.lines[self.index[key]])[1]
+
+    def set(self, key: str, value):
+        line = f"# {key} is not set" if value is None else f"{key}={value}"
+        if key in self.index:
+            self.lines[self.index[key]] = line
+        else:
+            self.index[key] = len(self.lines)
+            self.lines.append(line)
+
+    def diff(self) -> list:
+        """Return (key, old, new) for every option whose value differs from the parsed file."""
+        changes = []
+        for key in self.index:
+            old = self.original.get(key, "absent")
+            new = self.get(key)
+            if old != new:
+                changes.append((key, old, new))
+        return changes
+
+    def text(self) -> str:
+        return "\n".join(self.lines) + "\n"
+
+def parse_config_option(line: str):
+    """Parse a "CONFIG_X=v" or "# CONFIG_X is not set" line into (key, value).
+
+    "CONFIG_X=n" is normalised to None like the "is not set" form. Returns None
+    for lines that are not option assignments.
+    """
+    line = line.strip()
+    match = Defconfig.OPTION_LINE.match(line)
+    if match:
+        key, value = match.groups()
+        return key, None if value == "n" else value
+    match = Defconfig.UNSET_LINE.match(line)
+    if match:
+        return match.group(1), None
+    return None
+
+def collect_config_tweaks(config: dict) -> list:
+    """Return the CONFIG_* lines requested by the enabled features and custom configs."""
+    config_tweaks = []
+    features = config.get("features", {})
+    for feature, feature_configs in FEATURE_CONFIGS.items():
+        if features.get(feature, False):
+            config_tweaks.extend(feature_configs)
+
+    config_tweaks.extend(config.get("custom_kernel_configs", []))
+    return config_tweaks
+
+def merge_config_tweaks(defconfig: Defconfig, config_tweaks: list) -> Defconfig:
+    """Apply CONFIG_* tweak lines to a parsed defconfig in memory."""
+    for tweak in config_tweaks:
+        if not tweak.strip():
+            continue
+        option = parse_config_option(tweak)
+        if option is None:
+            if not tweak.strip().startswith("#"):
+                logger.error(f"Failed to apply tweak: {tweak}")
+            continue
+        defconfig.set(*option)
+    return defconfig
+
+def format_config_value(value) -> str:
+    """Render a Defconfig value for log output."""
+    return "not set" if value is None else value
+
 def apply_kernel_config_tweaks(kernel_wsl_dir: str, config: dict, skip_config_tweaks: bool = False):
-    """Apply kernel configuration tweaks to the defconfig file within WSL."""
+    """Apply kernel configuration tweaks to the defconfig file within WSL.
+
+    The defconfig is read once, all tweaks are merged in memory, and the result is
+    written back in a single atomic replace. Returns the list of changed options.
+    """
     if skip_config_tweaks:
         logger.info("Skipping kernel config tweaks as requested.")
-        return
+        return []
 
     step_update("Applying kernel configuration tweaks")
     progress_update(45, "Configuring kernel features")
@@ -243,73 +1317,187 @@ def apply_kernel_config_tweaks(kernel_wsl_dir: str, config: dict, skip_config_tw
 
     logger.info(f"Applying kernel config tweaks to {full_defconfig_wsl_path}")
 
-    config_tweaks = []
-    features = config.get("features", {})
-    
-    if features.get("wifi_monitor_mode", False):
-        config_tweaks.extend([
-            "CONFIG_PACKET=y",
-            "CONFIG_CFG80211_WEXT=y",
-            "CONFIG_MAC80211=y",
-            "CONFIG_RFKILL=y",
-        ])
-    
-    if features.get("usb_gadget", False):
-        config_tweaks.extend([
-            "CONFIG_USB_GADGET=y",
-            "CONFIG_USB_CONFIGFS=y",
-            "CONFIG_USB_CONFIGFS_F_FS=y", 
-            "CONFIG_USB_CONFIGFS_F_ACM=y",
-            "CONFIG_USB_CONFIGFS_F_ECM=y",
-            "CONFIG_USB_CONFIGFS_F_RNDIS=y",
-        ])
-    
-    if features.get("hid_support", False):
-        config_tweaks.extend([
-            "CONFIG_USB_CONFIGFS_F_HID=y",
-            "CONFIG_UHID=y",
-            "CONFIG_HIDRAW=y"
-        ])
+    config_tweaks = collect_config_tweaks(config)
+    if not config_tweaks:
+        logger.info("No kernel config tweaks to apply.")
+        return []
+
+    # Ensure the defconfig exists and read it in the same call
+    defconfig_parent_dir_wsl = full_defconfig_wsl_path.rsplit('/', 1)[0]
+    defconfig_text = run_command(
+        f"mkdir -p '{defconfig_parent_dir_wsl}' && touch '{full_defconfig_wsl_path}' && cat '{full_defconfig_wsl_path}'",
+        wsl=True, wsl_distro=distro_name
+    )
+    defconfig = merge_config_tweaks(Defconfig(defconfig_text), config_tweaks)
+
+    progress_update(48, f"Merged {len(config_tweaks)} config tweaks")
+
+    changes = defconfig.diff()
+    if not changes:
+        logger.info("Defconfig already contains all requested options.")
+        progress_update(50, "Kernel configuration tweaks applied (no changes)")
+        return []
+
+    tmp_path = f"{full_defconfig_wsl_path}.customizer.tmp"
+    try:
+        run_command(f"cat > '{tmp_path}' && mv -f '{tmp_path}' '{full_defconfig_wsl_path}'",
+                    wsl=True, wsl_distro=distro_name, input=defconfig.text())
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Failed to write defconfig {full_defconfig_wsl_path}: {e}")
+        raise SystemExit("Applying kernel config tweaks failed.")
+
+    logger.info(f"Changed {len(changes)} option(s) in {defconfig_filename}:")
+    for key, old, new in changes:
+        logger.info(f"  {key}: {format_config_value(old)} -> {format_config_value(new)}")
     
-    if features.get("rtl8812au_driver", False):
-        config_tweaks.append("CONFIG_RTL8812AU=m")
+    progress_update(50, f"Kernel configuration tweaks applied ({len(changes)} changed)")
+    return changes
+
+def requested_config_options(config: dict) -> dict:
+    """Map each CONFIG_* option the config asks for to (value, where it was requested)."""
+    requested = {}
+    features = config.get("features", {})
+    for feature, feature_configs in FEATURE_CONFIGS.items():
+        if features.get(feature, False):
+            for line in feature_configs:
+                option = parse_config_option(line)
+                if option:
+                    requested[option[0]] = (option[1], f"feature {feature}")
+    for line in config.get("custom_kernel_configs", []):
+        option = parse_config_option(line)
+        if option:
+            requested[option[0]] = (option[1], "custom_kernel_configs")
+    return requested
 
-    custom_configs = config.get("custom_kernel_configs", [])
-    config_tweaks.extend(custom_configs)
+def config_value_satisfied(requested, resolved) -> bool:
+    """Whether a resolved .config value fulfils a requested one (a module request is met by built-in)."""
+    return requested == resolved or (requested == "m" and resolved == "y")
 
-    if not config_tweaks:
-        logger.info("No kernel config tweaks to apply.")
-        return
+def kconfig_dependencies(kernel_wsl_dir: str, symbols: list, distro_name: str) -> dict:
+    """Return {symbol: [depends on expressions]} from the Kconfig files, for the symbols defined there."""
+    awk_program = (
+        'BEGIN { n = split(syms, list, " "); for (i = 1; i <= n; i++) want[list[i]] = 1 } '
+        '/^[ \t]*(menu)?config[ \t]+/ { cur = ($2 in want) ? $2 : ""; if (cur != "") print "SYMBOL " cur; next } '
+        '/^[ \t]*(choice|endchoice|menu|endmenu|if|endif|source|comment|help|---help---)([ \t]|$)/ { cur = "" } '
+        'cur != "" && /^[ \t]*depends on/ { sub(/^[ \t]*depends on[ \t]*/, ""); print "DEPENDS " cur " " $0 }'
+    )
+    names = " ".join(symbol[len("CONFIG_"):] for symbol in symbols)
+    deps_cmd = (f"cd '{kernel_wsl_dir}' && find . -name 'Kconfig*' -not -path './.git/*' -print0 | "
+                f"xargs -0 -r awk -v syms={shlex.quote(names)} {shlex.quote(awk_program)}")
+    dependencies = {}
+    for line in run_command(deps_cmd, wsl=True, wsl_distro=distro_name).splitlines():
+        fields = line.split(None, 2)
+        if len(fields) >= 2 and fields[0] == "SYMBOL":
+            dependencies.setdefault(f"CONFIG_{fields[1]}", [])
+        elif len(fields) == 3 and fields[0] == "DEPENDS":
+            dependencies.setdefault(f"CONFIG_{fields[1]}", []).append(fields[2].strip())
+    return dependencies
+
+def describe_unmet_dependencies(expressions: list, resolved: Defconfig) -> str:
+    """Render depends-on expressions with the resolved value of every symbol they mention."""
+    parts = []
+    for expression in expressions:
+        values = []
+        for symbol in dict.fromkeys(re.findall(r"\b[A-Za-z][A-Za-z0-9_]*\b", expression)):
+            if symbol in ("y", "m", "n"):
+                continue
+            key = f"CONFIG_{symbol}"
+            value = resolved.get(key) if key in resolved else None
+            values.append(f"{symbol}={format_config_value(value)}")
+        parts.append(f"{expression} [{', '.join(values)}]" if values else expression)
+    return "; ".join(parts)
 
-    # Ensure defconfig parent directory exists
-    defconfig_parent_dir_wsl = str(Path(full_defconfig_wsl_path).parent)
-    run_command(f"mkdir -p '{defconfig_parent_dir_wsl}'", wsl=True, wsl_distro=distro_name)
-    run_command(f"touch '{full_defconfig_wsl_path}'", wsl=True, wsl_distro=distro_name)
+def preflight_kernel_config(kernel_wsl_dir: str, output_wsl_dir: str, config: dict):
+    """Check that the requested options survived config generation, before anything compiles.
+
+    Kconfig silently drops options with unmet dependencies. Dropped options fail
+    the build with their depends-on lines and the current values of the symbols
+    involved; options that merely resolved to another value only log a warning.
+    """
+    distro_name = config["wsl_distro_name"]
+    requested = requested_config_options(config)
+    if not requested:
+        return
+    resolved = Defconfig(run_command(f"cat '{output_wsl_dir}/.config'", wsl=True, wsl_distro=distro_name))
 
-    for i, tweak in enumerate(config_tweaks):
-        if not tweak.strip() or tweak.strip().startswith("#"):
+    dropped = []
+    for key, (value, source) in requested.items():
+        actual = resolved.get(key) if key in resolved else None
+        if config_value_satisfied(value, actual):
             continue
+        if value is not None and actual is None:
+            dropped.append((key, value, source))
+        else:
+            logger.warning(f"{key} resolved to {format_config_value(actual)} instead of "
+                           f"{format_config_value(value)} (requested by {source})")
 
-        escaped_tweak = tweak.replace("'", "'\\''")
-        config_name = tweak.split('=')[0]
-        
-        sed_cmd_delete = f"sed -i '/^{config_name}=/d; /^{config_name} is not set/d' '{full_defconfig_wsl_path}'"
-        echo_cmd_add = f"echo '{escaped_tweak}' >> '{full_defconfig_wsl_path}'"
-        full_shell_cmd = f"{sed_cmd_delete} && {echo_cmd_add}"
-        
-        try:
-            run_command(full_shell_cmd, wsl=True, wsl_distro=distro_name)
-            progress_update(45 + int((i + 1) / len(config_tweaks) * 5), f"Applied config: {config_name}")
-        except subprocess.CalledProcessError:
-            logger.error(f"Failed to apply tweak: {tweak}")
-    
-    progress_update(50, "Kernel configuration tweaks applied")
+    if not dropped:
+        logger.info(f"Kernel config pre-flight passed: all {len(requested)} requested options are set")
+        return
+
+    dependencies = kconfig_dependencies(kernel_wsl_dir, [key for key, _, _ in dropped], distro_name)
+    for key, value, source in dropped:
+        if key not in dependencies:
+            reason = "no Kconfig in this kernel defines it"
+        elif dependencies[key]:
+            reason = f"depends on {describe_unmet_dependencies(dependencies[key], resolved)}"
+        else:
+            reason = "it has no dependencies; check for a choice or if block around it"
+        logger.error(f"{key}={value} (requested by {source}) was dropped: {reason}")
+    raise SystemExit(f"Kernel config pre-flight failed: {len(dropped)} requested option(s) dropped by Kconfig: "
+                     f"{', '.join(key for key, _, _ in dropped)}")
+
+def state_dir(config: dict) -> Path:
+    """Return (and create) the directory for caches and state inside output_dir."""
+    path = Path(config["output_dir"]).expanduser().resolve() / STATE_DIR_NAME
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+def load_state_file(path: Path) -> dict:
+    """Read a JSON state file, treating a missing or corrupt file as empty."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (json.JSONDecodeError, IOError) as e:
+        logger.warning(f"Ignoring unreadable state file {path}: {e}")
+        return {}
+
+def save_state_file(path: Path, data: dict):
+    """Atomically replace a JSON state file."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def sparse_widen_for_patches_script(patch_paths: list, patch_level) -> str:
+    """Return shell commands that add the directories a patch series touches to the sparse cone.
+
+    Paths are read from the ---/+++ headers with patch_level components removed.
+    Only directories that exist in HEAD but are missing from the checkout are added.
+    """
+    strip_level = int(patch_level)
+    quoted_paths = " ".join(shlex.quote(path) for path in patch_paths)
+    return (
+        f"kc_widen=$(awk '/^(---|\\+\\+\\+) / && $2 != \"/dev/null\" "
+        f"{{ n = split($2, parts, \"/\"); path = \"\"; "
+        f"for (i = {strip_level} + 1; i <= n; i++) path = path (path == \"\" ? \"\" : \"/\") parts[i]; print path }}' "
+        f"{quoted_paths} | {SPARSE_CONE_DIRS_AWK} | "
+        f"while read -r dir; do [ -e \"$dir\" ] || ! git cat-file -e \"HEAD:$dir\" 2>/dev/null || echo \"$dir\"; done)\n"
+        f"if [ -n \"$kc_widen\" ] && git sparse-checkout add $kc_widen; then echo SPARSE_WIDENED $kc_widen; fi"
+    )
 
 def apply_nethunter_patches(kernel_wsl_dir: str, nethunter_patches_source_wsl_dir: str, config: dict, skip_patches: bool = False):
-    """Apply NetHunter patches to the kernel source in WSL."""
+    """Apply NetHunter patches to the kernel source in WSL.
+
+    The whole sorted series is applied by one shell call. Outcomes are cached by
+    (kernel HEAD, patch hash, patch level) so known conflicts are not retried.
+    Returns a mapping of patch name to applied/already_applied/conflict/skipped.
+    """
     if skip_patches:
         logger.info("Skipping NetHunter patches as requested.")
-        return
+        return {}
 
     step_update("Applying NetHunter patches")
     progress_update(55, "Locating patch files")
@@ -319,50 +1507,521 @@ def apply_nethunter_patches(kernel_wsl_dir: str, nethunter_patches_source_wsl_di
     
     if not relative_patch_dir:
         logger.warning("NetHunter patches directory not specified. Skipping patches.")
-        return
+        return {}
 
     patch_dir_wsl = f"{nethunter_patches_source_wsl_dir.rstrip('/')}/{relative_patch_dir.lstrip('/')}"
-    
-    try:
-        run_command(f"test -d '{patch_dir_wsl}'", wsl=True, wsl_distro=distro_name)
-        logger.info(f"Found NetHunter patch directory: {patch_dir_wsl}")
-    except subprocess.CalledProcessError:
-        logger.warning(f"NetHunter patch directory not found at '{patch_dir_wsl}'. Skipping patching.")
-        return
 
+    # Kernel HEAD and the hashed patch series come back from a single call
+    list_cmd = (
+        f"git -C '{kernel_wsl_dir}' rev-parse HEAD 2>/dev/null || echo unknown; "
+        f"if [ ! -d '{patch_dir_wsl}' ]; then echo __MISSING__; exit 0; fi; "
+        f"cd '{patch_dir_wsl}' && find . -maxdepth 1 -type f -name '*.patch' -print0 | sort -z | xargs -0 -r sha256sum"
+    )
     try:
-        ls_cmd = f"find '{patch_dir_wsl}' -maxdepth 1 -type f -name '*.patch' -print0 | sort -z | xargs -0 -n 1 basename"
-        patch_files_str = run_command(ls_cmd, wsl=True, wsl_distro=distro_name)
-        patch_files = [f.strip() for f in patch_files_str.splitlines() if f.strip()]
+        list_output = run_command(list_cmd, wsl=True, wsl_distro=distro_name).splitlines()
     except subprocess.CalledProcessError:
         logger.warning(f"Could not list .patch files from '{patch_dir_wsl}'.")
-        patch_files = []
+        return {}
+
+    kernel_head = list_output[0].strip() if list_output else "unknown"
+    if "__MISSING__" in list_output[1:2]:
+        logger.warning(f"NetHunter patch directory not found at '{patch_dir_wsl}'. Skipping patching.")
+        return {}
+    logger.info(f"Found NetHunter patch directory: {patch_dir_wsl}")
 
-    if not patch_files:
+    patch_hashes = {}
+    for line in list_output[1:]:
+        if line.strip():
+            digest, name = line.split(None, 1)
+            patch_hashes[name.strip()[2:]] = digest
+
+    if not patch_hashes:
         logger.info("No .patch files found in NetHunter patch directory.")
-        return
+        return {}
 
     patch_level = config.get("git_patch_level", "1")
-    total_patches = len(patch_files)
-    
-    for i, patch_file_name in enumerate(patch_files):
-        full_patch_path_wsl = f"{patch_dir_wsl}/{patch_file_name}"
-        logger.info(f"Applying patch {i + 1}/{total_patches}: {patch_file_name}")
-        
-        check_cmd = f"git apply -p{patch_level} --check --verbose '{full_patch_path_wsl}'"
-        apply_cmd = f"git apply -p{patch_level} --verbose '{full_patch_path_wsl}'"
-        
-        wsl_shell_cmd_check = f"cd '{kernel_wsl_dir}' && {check_cmd}"
-        wsl_shell_cmd_apply = f"cd '{kernel_wsl_dir}' && {apply_cmd}"
+    total_patches = len(patch_hashes)
+
+    # Known outcomes for this (kernel HEAD, patch content, patch level)
+    cache_path = state_dir(config) / "patch_cache.json"
+    patch_cache = load_state_file(cache_path)
+    cache_keys = {name: f"{kernel_head}:{digest}:{patch_level}" for name, digest in patch_hashes.items()}
+    known_good = sum(1 for key in cache_keys.values() if patch_cache.get(key) in ("applied", "already_applied"))
+    known_bad = sum(1 for key in cache_keys.values() if patch_cache.get(key) == "conflict")
+    logger.info(f"Applying {total_patches} patches ({known_good} known good, {known_bad} known conflicting)")
+    progress_update(57, f"Applying {total_patches} patches")
+
+    series_cmd = [APPLY_PATCH_FUNCTION, f"cd '{kernel_wsl_dir}' || exit 1"]
+    if config.get("kernel_sparse_checkout", False):
+        series_cmd.append(sparse_widen_for_patches_script(
+            [f"{patch_dir_wsl}/{name}" for name in patch_hashes], patch_level))
+    for name in patch_hashes:
+        hint = patch_cache.get(cache_keys[name], "unknown")
+        series_cmd.append(f"kc_patch {shlex.quote(name)} {shlex.quote(f'{patch_dir_wsl}/{name}')} {hint} {shlex.quote(str(patch_level))}")
 
+    try:
+        series_output = run_command("\n".join(series_cmd), wsl=True, wsl_distro=distro_name)
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Failed to run the NetHunter patch series: {e}")
+        return {}
+
+    results = {}
+    for line in series_output.splitlines():
+        if line.startswith("SPARSE_WIDENED "):
+            logger.info(f"Patches touch paths outside the sparse checkout; added {line[len('SPARSE_WIDENED '):]}")
+        elif line.startswith("PATCH_RESULT "):
+            _, status, name = line.split(" ", 2)
+            results[name] = status
+            if status == "applied":
+                logger.info(f"Successfully applied patch: {name}")
+            elif status == "already_applied":
+                logger.info(f"Patch already applied: {name}")
+            elif status == "skipped":
+                logger.warning(f"Skipping patch known to conflict with this kernel: {name}")
+            else:
+                logger.error(f"Failed to apply patch '{name}'")
+                logger.warning("Continuing with next patch...")
+        elif line.startswith("PATCH_DETAIL "):
+            logger.warning(f"  {line[len('PATCH_DETAIL '):]}")
+
+    if kernel_head != "unknown":
+        for name, status in results.items():
+            if status != "skipped":
+                patch_cache[cache_keys[name]] = status
+        save_state_file(cache_path, patch_cache)
+
+    counts = {status: list(results.values()).count(status) for status in ("applied", "already_applied", "conflict", "skipped")}
+    progress_update(65, f"Patches: {counts['applied']} applied, {counts['already_applied']} already applied, "
+                        f"{counts['conflict'] + counts['skipped']} conflicting")
+    return results
+
+def compute_build_fingerprint(kernel_wsl_dir: str, config: dict) -> dict:
+    """Collect the inputs that decide whether an existing object tree can be reused.
+
+    The patch set is the diff of the working tree against HEAD plus any untracked
+    files the patches created, with the defconfig left out since it is tracked on
+    its own. "tree" hashes everything except the defconfig: kbuild already rebuilds
+    only the affected objects when just the configuration changes.
+    """
+    distro_name = config["wsl_distro_name"]
+    defconfig_filename = config["defconfig_filename_template"].format(codename=config["codename"])
+    quoted_defconfig = shlex.quote(defconfig_filename)
+
+    fingerprint_cmd = (
+        f"cd '{kernel_wsl_dir}' && git rev-parse HEAD && "
+        f"{{ git diff --binary HEAD -- . ':(exclude){defconfig_filename}'; "
+        f"git ls-files -z -o --exclude-standard | xargs -0 -r sha256sum; }} | sha256sum && "
+        f"{{ sha256sum {quoted_defconfig} 2>/dev/null || echo missing; }}"
+    )
+    head_line, patches_line, defconfig_line = run_command(fingerprint_cmd, wsl=True, wsl_distro=distro_name).splitlines()[:3]
+
+    fingerprint = {
+        "head": head_line.strip(),
+        "patches": patches_line.split()[0],
+        "defconfig": defconfig_line.split()[0],
+        "arch": config.get("kernel_arch", "arm64"),
+        "toolchain": config.get("kernel_cross_compile", "aarch64-linux-gnu-"),
+    }
+    tree_inputs = json.dumps({k: v for k, v in fingerprint.items() if k != "defconfig"}, sort_keys=True)
+    fingerprint["tree"] = hashlib.sha256(tree_inputs.encode("utf-8")).hexdigest()[:16]
+    return fingerprint
+
+def module_only_config_changes(build_dir: str, config: dict) -> list:
+    """Return the option changes since the last compile in build_dir if they only touch modules.
+
+    Changes qualify when every changed option moves between "m" and not set, the
+    kernel supports modules and a previous compile finished in this directory.
+    Returns an empty list otherwise, or when nothing changed at all.
+    """
+    compare_cmd = (f"cd '{build_dir}' && if [ ! -f '{BUILT_CONFIG_FILE}' ]; then echo __NONE__; exit 0; fi; "
+                   f"cat '{BUILT_CONFIG_FILE}'; echo __CURRENT__; cat .config")
+    output = run_command(compare_cmd, wsl=True, wsl_distro=config["wsl_distro_name"])
+    if "__NONE__" in output or "__CURRENT__" not in output:
+        return []
+    previous_text, current_text = output.split("__CURRENT__", 1)
+    previous, current = Defconfig(previous_text), Defconfig(current_text)
+    if "CONFIG_MODULES" not in current or current.get("CONFIG_MODULES") != "y":
+        return []
+
+    changes = []
+    for key in sorted(set(previous.index) | set(current.index)):
+        old = previous.get(key) if key in previous else None
+        new = current.get(key) if key in current else None
+        if old == new:
+            continue
+        if old not in (None, "m") or new not in (None, "m"):
+            return []
+        changes.append((key, old, new))
+    return changes
+
+def builtin_objects_using_options(build_dir: str, keys: list, config: dict) -> list:
+    """Return the .cmd files of built-in objects in build_dir that depend on any of keys.
+
+    fixdep records every CONFIG_ symbol a source file tests as a dependency on
+    include/config/FOO (5.13+) or include/config/foo.h (older kernels). Built-in
+    objects are the members of the top-level vmlinux.a or built-in.a thin
+    archive; when neither can be listed every object's .cmd file is checked.
+    """
+    patterns = []
+    for key in keys:
+        name = key[len("CONFIG_"):] if key.startswith("CONFIG_") else key
+        patterns.append(f"include/config/{name}([^A-Za-z0-9_]|$)")
+        patterns.append(f"include/config/{name.lower().replace('_', '/')}\\.h")
+    pattern = "|".join(patterns)
+    list_cmd = (f"cd '{build_dir}' && {{ for archive in vmlinux.a built-in.a; do "
+                f"if [ -f \"$archive\" ] && ar t \"$archive\" 2>/dev/null; then exit 0; fi; done; "
+                f"find . -name '*.o' ! -name '*.mod.o' | sed 's#^\\./##'; }}")
+    check_cmd = (f"( {list_cmd} ) | grep '\\.o$' | sed -E 's#(^|/)([^/]+)$#\\1.\\2.cmd#' "
+                 f"| ( cd '{build_dir}' && xargs -r grep -lE '{pattern}' 2>/dev/null ) || true")
+    output = run_command(check_cmd, wsl=True, wsl_distro=config["wsl_distro_name"])
+    return [line.strip() for line in output.splitlines() if line.strip()]
+
+def mrproper_if_configured_cmd(config: dict) -> str:
+    """Return a shell command that runs make mrproper when the source tree holds build state.
+
+    It has to run with ARCH exported: kbuild refuses O= builds while
+    arch/$(SRCARCH)/include/generated exists in the source tree, and mrproper
+    only removes the generated headers of the architecture it was run for.
+    """
+    arch = config.get("kernel_arch", "arm64")
+    return (f"if [ -f .config ] || [ -d include/config ] || [ -d 'arch/{arch}/include/generated' ]; "
+            f"then make mrproper >/dev/null; fi")
+
+def prepare_incremental_build_dir(kernel_wsl_dir: str, config: dict, env_exports: str,
+                                  fingerprint: dict = None) -> str:
+    """Pick the out-of-tree build directory for the current inputs and get it ready.
+
+    Each tree fingerprint gets its own O= directory next to the kernel source, so
+    switching back and forth between trees reuses both object sets. Only the most
+    recently used incremental_keep_build_dirs directories are kept. env_exports
+    is the build environment from prepare_build_environment.
+    """
+    distro_name = config["wsl_distro_name"]
+    fingerprint = fingerprint or compute_build_fingerprint(kernel_wsl_dir, config)
+
+    build_root = f"{kernel_wsl_dir.rstrip('/').rsplit('/', 1)[0]}/kernel_out"
+    build_dir = f"{build_root}/{fingerprint['tree']}"
+    fingerprint_path = f"{build_dir}/{BUILD_FINGERPRINT_FILE}"
+    keep_dirs = max(int(config.get("incremental_keep_build_dirs", 3)), 1)
+
+    # kbuild refuses O= builds while the source tree itself holds a configuration
+    prepare_cmd = (
+        f"cd '{kernel_wsl_dir}' && ( {env_exports} && {mrproper_if_configured_cmd(config)} ) && "
+        f"cat '{fingerprint_path}' 2>/dev/null; "
+        f"mkdir -p '{build_dir}' && touch '{build_dir}' && "
+        f"cd '{build_root}' && ls -1t | tail -n +{keep_dirs + 1} | xargs -r rm -rf"
+    )
+    previous_output = run_command(prepare_cmd, wsl=True, wsl_distro=distro_name).strip()
+
+    previous = None
+    if previous_output:
         try:
-            run_command(wsl_shell_cmd_check, wsl=True, wsl_distro=distro_name)
-            run_command(wsl_shell_cmd_apply, wsl=True, wsl_distro=distro_name)
-            progress_update(55 + int((i + 1) / total_patches * 10), f"Applied patch: {patch_file_name}")
-            logger.info(f"Successfully applied patch: {patch_file_name}")
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Failed to apply patch '{patch_file_name}': {e}")
-            logger.warning("Continuing with next patch...")
+            previous = json.loads(previous_output)
+        except json.JSONDecodeError:
+            logger.warning(f"Ignoring unreadable build fingerprint in {build_dir}")
+
+    if previous is None:
+        logger.info(f"Starting a fresh out-of-tree build in {build_dir}")
+    elif previous.get("defconfig") != fingerprint["defconfig"]:
+        logger.info(f"Reusing object tree {build_dir}; defconfig changed, only affected objects will rebuild")
+    else:
+        logger.info(f"Reusing object tree {build_dir}; inputs unchanged")
+
+    run_command(f"printf '%s' {shlex.quote(json.dumps(fingerprint, sort_keys=True))} > '{fingerprint_path}'",
+                wsl=True, wsl_distro=distro_name)
+    return build_dir
+
+def wsl_home_path(path: str) -> str:
+    """Quote a path for a WSL shell command, expanding a leading ~ to the WSL user's $HOME."""
+    if path == "~" or path.startswith("~/"):
+        return f'"$HOME{path[1:]}"'
+    return shlex.quote(path)
+
+def ccache_wsl_dir(config: dict) -> str:
+    """Return the quoted ccache directory for this build's architecture and toolchain.
+
+    Devices sharing a kernel base and toolchain land in the same namespace and
+    therefore reuse each other's objects.
+    """
+    arch = config.get("kernel_arch", "arm64")
+    cross_compile_prefix = config.get("kernel_cross_compile", "aarch64-linux-gnu-")
+    namespace = f"{arch}-{cross_compile_prefix.rstrip('-') or 'native'}"
+    return wsl_home_path(f"{config['ccache_dir'].rstrip('/')}/{namespace}")
+
+def parse_ccache_stats(output: str) -> dict:
+    """Extract hit/miss counters from `ccache -s` output (ccache 3.x and 4.x formats)."""
+    def first_int(pattern):
+        match = re.search(pattern, output, re.MULTILINE | re.IGNORECASE)
+        return int(match.group(1)) if match else None
+
+    hits = first_int(r"^\s*Hits:\s+(\d+)")
+    misses = first_int(r"^\s*Misses:\s+(\d+)")
+    if hits is None:
+        direct = first_int(r"^cache hit \(direct\)\s+(\d+)") or 0
+        preprocessed = first_int(r"^cache hit \(preprocessed\)\s+(\d+)") or 0
+        hits = direct + preprocessed
+    if misses is None:
+        misses = first_int(r"^cache miss\s+(\d+)") or 0
+
+    stats = {"hits": hits, "misses": misses}
+    total = hits + misses
+    stats["hit_rate"] = f"{hits / total * 100:.2f}" if total else "0.00"
+
+    size_match = re.search(r"^\s*cache size(?: \((\w+)\))?:?\s+([\d.]+)\s*(\w+)?", output, re.MULTILINE | re.IGNORECASE)
+    if size_match:
+        stats["size"] = f"{size_match.group(2)}{size_match.group(1) or size_match.group(3) or ''}"
+    return stats
+
+def detect_make_jobs(config: dict, remote_slots: int = 0) -> int:
+    """Return the make -j budget: make_jobs when set, otherwise the WSL core count, plus remote_slots."""
+    if int(config.get("make_jobs", 0)) > 0:
+        return int(config["make_jobs"]) + remote_slots
+    try:
+        num_cores = int(run_command("nproc", wsl=True, wsl_distro=config["wsl_distro_name"]).strip())
+    except (subprocess.CalledProcessError, ValueError) as e:
+        logger.warning(f"Could not determine number of cores: {e}. Using 1 core.")
+        num_cores = 1
+    if remote_slots:
+        logger.info(f"Using {num_cores} local cores and {remote_slots} remote slots for parallel build")
+    else:
+        logger.info(f"Using {num_cores} cores for parallel build")
+    return num_cores + remote_slots
+
+def parse_distributed_host(spec: str, default_port: int):
+    """Split a distcc-style "host[:port][/slots][,options]" entry into (host, port, slots)."""
+    match = re.fullmatch(r"([^\s:/,]+)(?::(\d+))?(?:/(\d+))?(?:,\S*)?", spec.strip())
+    if not match:
+        raise SystemExit(f"Invalid distributed_hosts entry: {spec!r}. Use host[:port][/slots].")
+    host, port, slots = match.groups()
+    return host, int(port or default_port), int(slots or DISTRIBUTED_DEFAULT_SLOTS)
+
+def probe_distributed_hosts(output_root: str, config: dict) -> list:
+    """Return the distributed_hosts entries whose compile daemon accepts connections.
+
+    One shell command checks that the compiler wrapper is installed, truncates
+    the distcc log and tries a TCP connection to every host. An empty list means
+    the build has to stay local.
+    """
+    compiler = config["distributed_compiler"]
+    default_port = DISTRIBUTED_COMPILERS[compiler]
+    hosts = {spec: parse_distributed_host(spec, default_port) for spec in config.get("distributed_hosts", [])}
+    if not hosts:
+        logger.warning(f"distributed_compiler is {compiler} but distributed_hosts is empty.")
+        return []
+
+    timeout = int(config.get("distributed_connect_timeout", 2))
+    # distcc compiles "localhost" entries itself instead of contacting a daemon
+    targets = " ".join(shlex.quote(f"{host}:{port}") for host, port, _ in hosts.values() if host != "localhost")
+    probe_cmd = (
+        f"command -v {compiler} >/dev/null || {{ echo __MISSING__; exit 0; }}; "
+        f": > '{output_root}/{DISTCC_LOG_FILE}'; "
+        f"for target in {targets}; do "
+        f"timeout {timeout} bash -c \"exec 3<>/dev/tcp/${{target%:*}}/${{target##*:}}\" 2>/dev/null && echo \"up $target\"; "
+        f"done; true"
+    )
+    output = run_command(probe_cmd, wsl=True, wsl_distro=config["wsl_distro_name"])
+    if "__MISSING__" in output:
+        logger.warning(f"{compiler} is not installed. Compiling locally.")
+        return []
+
+    up = {line.split(" ", 1)[1].strip() for line in output.splitlines() if line.startswith("up ")}
+    reachable = []
+    for spec, (host, port, _) in hosts.items():
+        if host == "localhost" or f"{host}:{port}" in up:
+            reachable.append(spec)
+        else:
+            logger.warning(f"{compiler} host {host}:{port} is unreachable; leaving it out of this build")
+    return reachable
+
+def prepare_build_environment(kernel_wsl_dir: str, config: dict):
+    """Return (env_exports, make_vars, use_ccache, remote_slots) for make invocations on this tree.
+
+    When ccache is enabled and available its statistics are zeroed, so the
+    numbers reported after the build belong to this build. With a
+    distributed_compiler, compiles go through distcc or icecc on the reachable
+    distributed_hosts, and remote_slots is their combined slot count.
+    """
+    distro_name = config["wsl_distro_name"]
+    arch = config.get("kernel_arch", "arm64")
+    cross_compile_prefix = config.get("kernel_cross_compile", "aarch64-linux-gnu-")
+
+    env_exports = f"export ARCH='{arch}' SUBARCH='{arch}' CROSS_COMPILE='{cross_compile_prefix}' KBUILD_BUILD_USER='NethunterHost' KBUILD_BUILD_HOST='WSL'"
+    make_vars = ""
+
+    use_ccache = config.get("ccache_enabled", True)
+    if use_ccache:
+        # CCACHE_BASEDIR makes paths relative so trees in other output dirs still hit;
+        # CCACHE_NOHASHDIR keeps the working directory out of the hash for the same reason
+        output_root = kernel_wsl_dir.rstrip('/').rsplit('/', 1)[0]
+        ccache_exports = (f" && export CCACHE_DIR={ccache_wsl_dir(config)} CCACHE_MAXSIZE='{config['ccache_max_size']}'"
+                          f" CCACHE_BASEDIR='{output_root}' CCACHE_NOHASHDIR=1")
+        try:
+            run_command(f"command -v ccache >/dev/null && {env_exports}{ccache_exports} && ccache -z", wsl=True, wsl_distro=distro_name)
+            logger.info(f"Using ccache in {ccache_wsl_dir(config)}")
+            env_exports += ccache_exports
+            make_vars = f" CC='ccache {cross_compile_prefix}gcc'"
+        except subprocess.CalledProcessError:
+            logger.warning("ccache is not available in WSL. Building without compiler cache.")
+            use_ccache = False
+
+    remote_slots = 0
+    compiler = config.get("distributed_compiler") or ""
+    if compiler:
+        if compiler not in DISTRIBUTED_COMPILERS:
+            raise SystemExit(f"Unknown distributed_compiler {compiler!r}. Choose one of: {', '.join(DISTRIBUTED_COMPILERS)}")
+        output_root = kernel_wsl_dir.rstrip('/').rsplit('/', 1)[0]
+        hosts = probe_distributed_hosts(output_root, config)
+        if hosts:
+            default_port = DISTRIBUTED_COMPILERS[compiler]
+            remote_slots = sum(slots for host, _, slots in (parse_distributed_host(spec, default_port) for spec in hosts)
+                               if host != "localhost")
+            if compiler == "distcc":
+                # The verbose log is the only place distcc records which host ran each compile
+                env_exports += (f" && export DISTCC_HOSTS={shlex.quote(' '.join(hosts))}"
+                                f" DISTCC_LOG='{output_root}/{DISTCC_LOG_FILE}' DISTCC_VERBOSE=1 DISTCC_FALLBACK=1")
+            elif config.get("icecc_version"):
+                env_exports += f" && export ICECC_VERSION={wsl_home_path(config['icecc_version'])}"
+            # ccache hands cache misses to the wrapper; without it the wrapper runs the compiler directly
+            if use_ccache:
+                env_exports += f" && export CCACHE_PREFIX={compiler}"
+            else:
+                make_vars = f" CC='{compiler} {cross_compile_prefix}gcc'"
+            logger.info(f"Distributing compiles with {compiler} across {', '.join(hosts)}")
+        else:
+            logger.warning(f"No {compiler} hosts are reachable. Compiling locally.")
+
+    return env_exports, make_vars, use_ccache, remote_slots
+
+def report_ccache_stats(env_exports: str, distro_name: str):
+    """Emit the CCACHE: line for the cache selected by env_exports."""
+    try:
+        stats_output = run_command(f"{env_exports} && ccache -s", wsl=True, wsl_distro=distro_name)
+        ccache_update(parse_ccache_stats(stats_output))
+    except subprocess.CalledProcessError:
+        logger.warning("Could not read ccache statistics.")
+
+def report_distributed_stats(env_exports: str, distro_name: str):
+    """Emit the DISTRIBUTED: line with the per-host job counts from the distcc log of this build.
+
+    Compiles distcc could not hand off, and those of "localhost" entries, count
+    as "local". icecc keeps no such record on the client, so nothing is reported for it.
+    """
+    match = re.search(r"DISTCC_LOG='([^']+)'", env_exports)
+    if not match:
+        return
+    try:
+        log_text = run_command(f"grep -E 'completed ok|running locally instead' '{match.group(1)}' || true",
+                               wsl=True, wsl_distro=distro_name)
+    except subprocess.CalledProcessError:
+        logger.warning("Could not read the distcc log.")
+        return
+
+    counts = {}
+    for line in log_text.splitlines():
+        host_match = re.search(r"compile \S+ on (\S+) completed ok", line)
+        host = "local"
+        if host_match:
+            host = host_match.group(1).split("/", 1)[0].split(",", 1)[0]
+            host = "local" if host == "localhost" else host
+        counts[host] = counts.get(host, 0) + 1
+    if counts:
+        distributed_update(dict(sorted(counts.items())))
+
+def parse_size_kb(size: str) -> int:
+    """Convert a ccache-style size such as "10G" or "512M" to KiB."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT])?i?B?\s*", str(size), re.IGNORECASE)
+    if not match:
+        raise SystemExit(f"Invalid size: {size}")
+    return int(float(match.group(1)) * SIZE_UNITS[(match.group(2) or "K").upper()])
+
+def artifact_cache_key(fingerprint: dict) -> str:
+    """Hash the build inputs (HEAD, patches, defconfig, arch, toolchain) into a cache key."""
+    inputs = json.dumps({k: v for k, v in fingerprint.items() if k != "tree"}, sort_keys=True)
+    return hashlib.sha256(inputs.encode("utf-8")).hexdigest()[:32]
+
+def collect_build_artifacts(output_wsl_dir: str, artifacts_wsl_dir: str, config: dict) -> list:
+    """Copy the outputs of a finished build into artifacts_wsl_dir and list them.
+
+    Only the locations kbuild writes to are read: the images in arch/<arch>/boot,
+    the DTBs under its dts directory, the modules named by modules.order and the
+    resolved .config. Returned paths are relative to artifacts_wsl_dir.
+    """
+    boot_dir = f"arch/{config.get('kernel_arch', 'arm64')}/boot"
+    image_names = " ".join(shlex.quote(name) for name in
+                           config.get("kernel_image_name_patterns", ["Image.gz-dtb", "Image.gz", "Image"]) + ["dtbo.img"])
+    collect_cmd = (
+        f"cd '{output_wsl_dir}' && rm -rf '{artifacts_wsl_dir}' && "
+        f"mkdir -p '{artifacts_wsl_dir}/boot' '{artifacts_wsl_dir}/dtbs' '{artifacts_wsl_dir}/modules' && "
+        f"cp .config '{artifacts_wsl_dir}/config' && "
+        f"for f in {image_names}; do if [ -f '{boot_dir}'/\"$f\" ]; then cp '{boot_dir}'/\"$f\" '{artifacts_wsl_dir}/boot/'; fi; done && "
+        f"if [ -d '{boot_dir}/dts' ]; then (cd '{boot_dir}/dts' && find . \\( -name '*.dtb' -o -name '*.dtbo' \\) "
+        f"-exec cp --parents -t '{artifacts_wsl_dir}/dtbs' {{}} +); fi && "
+        f"if [ -f modules.order ]; then sed -e 's/\\.o$/.ko/' -e 's,^kernel/,,' modules.order | "
+        f"while read -r m; do if [ -f \"$m\" ]; then echo \"$m\"; fi; done | "
+        f"xargs -r cp --parents -t '{artifacts_wsl_dir}/modules'; fi && "
+        f"cd '{artifacts_wsl_dir}' && find . -type f | sort"
+    )
+    output = run_command(collect_cmd, wsl=True, wsl_distro=config["wsl_distro_name"])
+    return [line.strip()[2:] for line in output.splitlines() if line.strip().startswith("./")]
+
+def restore_cached_artifacts(cache_key: str, artifacts_wsl_dir: str, config: dict):
+    """Copy a cache entry into artifacts_wsl_dir; return its file list, or None on a miss.
+
+    A hit touches the entry so eviction sees it as recently used.
+    """
+    entry = f"{wsl_home_path(config['artifact_cache_dir'].rstrip('/'))}/{cache_key}"
+    restore_cmd = (
+        f"if [ ! -f {entry}/{ARTIFACT_MANIFEST_FILE} ]; then echo __MISS__; exit 0; fi; "
+        f"touch {entry} && rm -rf '{artifacts_wsl_dir}' && mkdir -p '{artifacts_wsl_dir}' && "
+        f"cp -a {entry}/. '{artifacts_wsl_dir}/' && rm -f '{artifacts_wsl_dir}/{ARTIFACT_MANIFEST_FILE}' && "
+        f"cd '{artifacts_wsl_dir}' && find . -type f | sort"
+    )
+    output = run_command(restore_cmd, wsl=True, wsl_distro=config["wsl_distro_name"])
+    if "__MISS__" in output:
+        return None
+    return [line.strip()[2:] for line in output.splitlines() if line.strip().startswith("./")]
+
+def store_build_artifacts(cache_key: str, fingerprint: dict, artifacts_wsl_dir: str, files: list, config: dict):
+    """Add collected artifacts to the cache, then evict least recently used entries.
+
+    Entries are staged under a temporary name and renamed into place, so a
+    concurrent lookup never sees half an entry. Eviction keeps the newest
+    entries that fit into artifact_cache_max_size; the new entry always stays.
+    """
+    cache_root = wsl_home_path(config["artifact_cache_dir"].rstrip("/"))
+    max_size_kb = parse_size_kb(config.get("artifact_cache_max_size", "10G"))
+    manifest = {"key": cache_key, "inputs": fingerprint, "files": files, "created_at": time.time()}
+    staging = f"{cache_root}/.{cache_key}.$$"
+    store_cmd = (
+        f"mkdir -p {cache_root} && rm -rf {staging} && cp -a '{artifacts_wsl_dir}' {staging} && "
+        f"printf '%s' {shlex.quote(json.dumps(manifest, sort_keys=True))} > {staging}/{ARTIFACT_MANIFEST_FILE} && "
+        f"{{ [ -d {cache_root}/{cache_key} ] || mv -T {staging} {cache_root}/{cache_key}; }}; rm -rf {staging}; "
+        f"cd {cache_root} && total=0 && for d in $(ls -1t); do "
+        f"total=$((total + $(du -sk \"$d\" | cut -f1))); "
+        f"if [ \"$total\" -gt {max_size_kb} ] && [ \"$d\" != '{cache_key}' ]; then echo \"EVICT $d\"; rm -rf \"$d\"; fi; done"
+    )
+    try:
+        output = run_command(store_cmd, wsl=True, wsl_distro=config["wsl_distro_name"])
+        evicted = [line.split()[1] for line in output.splitlines() if line.startswith("EVICT ")]
+        logger.info(f"Stored build artifacts in cache entry {cache_key}" +
+                    (f"; evicted {len(evicted)} old entries" if evicted else ""))
+    except subprocess.CalledProcessError as e:
+        logger.warning(f"Could not store build artifacts in the cache: {e}")
+
+def report_build_artifacts(files: list, artifacts_wsl_dir: str, config: dict) -> list:
+    """Log where the collected artifacts are and return the kernel images among them."""
+    output_dir_windows = Path(config["output_dir"]).expanduser().resolve()
+    images = [f for f in files if f.startswith("boot/")]
+    if images:
+        logger.info("Kernel images:")
+        for image in images:
+            logger.info(f"  WSL path: {artifacts_wsl_dir}/{image}")
+            logger.info(f"  Windows path: {output_dir_windows / ARTIFACTS_DIR_NAME / image}")
+    dtbs = sum(1 for f in files if f.startswith("dtbs/"))
+    modules = sum(1 for f in files if f.startswith("modules/"))
+    logger.info(f"Artifacts in {output_dir_windows / ARTIFACTS_DIR_NAME}: "
+                f"{len(images)} image(s), {dtbs} DTB(s), {modules} module(s)")
+    return images
 
 def build_kernel_in_wsl(kernel_wsl_dir: str, config: dict, skip_build: bool = False):
     """Build the kernel in WSL."""
@@ -376,86 +2035,809 @@ def build_kernel_in_wsl(kernel_wsl_dir: str, config: dict, skip_build: bool = Fa
     distro_name = config["wsl_distro_name"]
     logger.info(f"Starting kernel build in WSL at {kernel_wsl_dir}")
 
-    arch = config.get("kernel_arch", "arm64")
-    cross_compile_prefix = config.get("kernel_cross_compile", "aarch64-linux-gnu-")
     codename = config["codename"]
     defconfig_target = config["defconfig_filename_template"].format(codename=codename).split('/')[-1]
+    artifacts_wsl_dir = f"{prepare_output_dir_wsl(config)}/{ARTIFACTS_DIR_NAME}"
 
-    try:
-        nproc_output = run_command("nproc", wsl=True, wsl_distro=distro_name)
-        num_cores = nproc_output.strip()
-        logger.info(f"Using {num_cores} cores for parallel build")
-    except Exception as e:
-        logger.warning(f"Could not determine number of cores: {e}. Using 1 core.")
-        num_cores = "1"
-        
-    env_exports = f"export ARCH='{arch}' SUBARCH='{arch}' CROSS_COMPILE='{cross_compile_prefix}' KBUILD_BUILD_USER='NethunterHost' KBUILD_BUILD_HOST='WSL'"
+    # Identical inputs produce identical outputs, so a cached result replaces the whole compile
+    fingerprint = cache_key = None
+    if config.get("artifact_cache", True) or config.get("incremental_build", False):
+        try:
+            fingerprint = compute_build_fingerprint(kernel_wsl_dir, config)
+        except subprocess.CalledProcessError as e:
+            logger.warning(f"Could not fingerprint the kernel tree; building without the artifact cache: {e}")
+    if fingerprint and config.get("artifact_cache", True) and not config.get("preflight_only", False):
+        cache_key = artifact_cache_key(fingerprint)
+        cached_files = restore_cached_artifacts(cache_key, artifacts_wsl_dir, config)
+        if cached_files is not None:
+            logger.info(f"Artifact cache hit ({cache_key}); skipping compilation")
+            images = report_build_artifacts(cached_files, artifacts_wsl_dir, config)
+            progress_update(100, f"Build restored from cache with {len(images)} kernel image(s)")
+            step_update("Build completed successfully")
+            return
+        logger.info(f"Artifact cache miss ({cache_key})")
 
-    build_steps = [
-        ("Clean previous build", "make clean && make mrproper", 70),
-        ("Generate kernel config", f"make '{defconfig_target}'", 75),
-        ("Compile kernel", f"make -j{num_cores}", 95)
-    ]
+    env_exports, make_vars, use_ccache, remote_slots = prepare_build_environment(kernel_wsl_dir, config)
+    num_cores = detect_make_jobs(config, remote_slots)
+
+    if config.get("incremental_build", False):
+        build_dir = prepare_incremental_build_dir(kernel_wsl_dir, config, env_exports, fingerprint)
+        output_wsl_dir = build_dir
+        # Remember the configuration each successful compile was made with for the module fast path
+        record_built_config = f" && cp '{build_dir}/.config' '{build_dir}/{BUILT_CONFIG_FILE}'"
+        build_steps = [
+            ("Generate kernel config", f"make O='{build_dir}'{make_vars} '{defconfig_target}'", 75),
+            ("Compile kernel", f"make O='{build_dir}'{make_vars} -j{num_cores}{record_built_config}", 95)
+        ]
+    else:
+        output_wsl_dir = kernel_wsl_dir
+        build_steps = [
+            ("Clean previous build", "make clean && make mrproper", 70),
+            ("Generate kernel config", f"make{make_vars} '{defconfig_target}'", 75),
+            ("Compile kernel", f"make{make_vars} -j{num_cores}", 95)
+        ]
 
-    for step_name, step_cmd, progress_target in build_steps:
+    previous_target = 65
+    for step_index, (step_name, step_cmd, progress_target) in enumerate(build_steps):
         full_wsl_shell_cmd = f"cd '{kernel_wsl_dir}' && {env_exports} && {step_cmd}"
         logger.info(f"Build step: {step_name}")
-        progress_update(progress_target - 2, step_name)
-        
+
+        # The compile step gets the whole span since the previous step as its progress range
+        step_progress = None
+        if step_name in ("Compile kernel", "Compile modules"):
+            estimated_objects = (MODULE_ESTIMATED_OBJECTS if step_name == "Compile modules"
+                                 else config.get("kernel_estimated_objects", 6000))
+            step_progress = OutputProgress(previous_target, progress_target, estimated_objects, step_name)
+            progress_update(previous_target, step_name)
+        else:
+            progress_update(progress_target - 2, step_name)
+
         try:
-            run_command(full_wsl_shell_cmd, wsl=True, wsl_distro=distro_name)
+            with instrument_stage(f"build/{step_name}"):
+                run_command(full_wsl_shell_cmd, wsl=True, wsl_distro=distro_name,
+                            stream=True, progress=step_progress)
             progress_update(progress_target, f"Completed: {step_name}")
         except subprocess.CalledProcessError as e:
             logger.error(f"Kernel build step failed: {step_name}")
+            if e.output:
+                logger.error(f"Last output lines:\n{e.output}")
             raise SystemExit("Kernel build failed.")
+        previous_target = progress_target
+
+        if step_name != "Generate kernel config":
+            continue
+        if config.get("kernel_config_preflight", True):
+            with instrument_stage("build/preflight"):
+                preflight_kernel_config(kernel_wsl_dir, output_wsl_dir, config)
+        if config.get("preflight_only", False):
+            progress_update(100, "Kernel config generated and checked; skipping compilation")
+            step_update("Pre-flight completed successfully")
+            return
+        if config.get("incremental_build", False) and config.get("module_fast_path", True):
+            module_changes = module_only_config_changes(output_wsl_dir, config)
+            builtin_users = []
+            if module_changes:
+                builtin_users = builtin_objects_using_options(
+                    output_wsl_dir, [key for key, _, _ in module_changes], config)
+                if builtin_users:
+                    logger.info(f"Built-in code depends on the changed module options "
+                                f"({', '.join(builtin_users[:3])}); running the full incremental build")
+            if module_changes and not builtin_users:
+                changed_keys = ", ".join(key for key, _, _ in module_changes)
+                logger.info(f"Only loadable modules changed ({changed_keys}); "
+                            f"rebuilding modules against the existing kernel image")
+                build_steps[step_index + 1] = (
+                    "Compile modules",
+                    f"make O='{build_dir}'{make_vars} -j{num_cores} modules{record_built_config}", 95)
+
+    if use_ccache:
+        report_ccache_stats(env_exports, distro_name)
+    if remote_slots:
+        report_distributed_stats(env_exports, distro_name)
+
+    step_update("Collecting build artifacts")
+    progress_update(97, "Collecting kernel images, DTBs and modules")
 
-    # Find compiled kernel images
-    step_update("Locating kernel images")
-    progress_update(97, "Searching for compiled kernel images")
-    
-    image_patterns = config.get("kernel_image_name_patterns", ["Image.gz-dtb", "Image.gz", "Image"])
-    find_cmd_parts = ["find . -maxdepth 3"]
-    
-    for i, pattern in enumerate(image_patterns):
-        find_cmd_parts.append(f"{'-o' if i > 0 else ''} -name '{pattern}'")
-    
-    find_images_cmd = f"cd '{kernel_wsl_dir}' && {' '.join(find_cmd_parts)}"
-    
     try:
-        found_images_output = run_command(find_images_cmd, wsl=True, wsl_distro=distro_name)
-        found_images = [img.strip() for img in found_images_output.splitlines() if img.strip()]
-        
-        if found_images:
-            logger.info("Found compiled kernel images:")
-            for img_path_relative in found_images:
-                full_wsl_image_path = f"{kernel_wsl_dir.rstrip('/')}/{img_path_relative.lstrip('./')}"
-                logger.info(f"  WSL path: {full_wsl_image_path}")
-                
-                output_dir_windows = Path(config["output_dir"]).expanduser().resolve()
-                win_image_path = output_dir_windows / "kernel_source" / img_path_relative.lstrip('./')
-                logger.info(f"  Windows path: {win_image_path.resolve()}")
-            
-            progress_update(100, f"Build completed successfully! Found {len(found_images)} kernel image(s)")
-            step_update("Build completed successfully")
-            logger.info("Kernel build completed successfully!")
-        else:
-            logger.warning("Could not locate compiled kernel images automatically.")
-            progress_update(100, "Build completed, but kernel images not found automatically")
-            
+        files = collect_build_artifacts(output_wsl_dir, artifacts_wsl_dir, config)
     except subprocess.CalledProcessError:
-        logger.warning("Failed to search for compiled kernel images.")
+        logger.warning("Failed to collect the build artifacts.")
         progress_update(100, "Build completed")
+        return
 
-def main():
+    images = report_build_artifacts(files, artifacts_wsl_dir, config)
+    if not images:
+        logger.warning("Could not locate compiled kernel images automatically.")
+        progress_update(100, "Build completed, but kernel images not found automatically")
+        return
+
+    if cache_key:
+        store_build_artifacts(cache_key, fingerprint, artifacts_wsl_dir, files, config)
+    progress_update(100, f"Build completed successfully! Found {len(images)} kernel image(s)")
+    step_update("Build completed successfully")
+    logger.info("Kernel build completed successfully!")
+
+class PipelineStage:
+    """One node of the build pipeline: a callable plus the stages it needs first.
+
+    func receives the results of all finished stages, keyed by stage name.
+    """
+
+    def __init__(self, name: str, func, depends_on=()):
+        self.name = name
+        self.func = func
+        self.depends_on = tuple(depends_on)
+
+def run_instrumented_stage(stage: PipelineStage, results: dict):
+    with instrument_stage(stage.name):
+        return stage.func(results)
+
+def run_pipeline(stages: list, max_workers: int = 4) -> dict:
+    """Run stages on a thread pool as soon as their dependencies have finished.
+
+    The first failing stage stops the scheduling of new stages and its exception
+    is re-raised here, so SystemExit keeps its meaning for main().
+    """
+    pending = {stage.name: stage for stage in stages}
+    results = {}
+    running = {}
+
+    executor = ThreadPoolExecutor(max_workers=max(int(max_workers), 1), thread_name_prefix="stage")
+    try:
+        while pending or running:
+            ready = [stage for stage in pending.values() if all(dep in results for dep in stage.depends_on)]
+            for stage in ready:
+                del pending[stage.name]
+                logger.debug(f"Starting pipeline stage: {stage.name}")
+                running[submit_in_context(executor, run_instrumented_stage, stage, dict(results))] = stage
+
+            if not running:
+                raise RuntimeError(f"Pipeline stages have unsatisfiable dependencies: {', '.join(pending)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                results[stage.name] = future.result()
+                logger.debug(f"Finished pipeline stage: {stage.name}")
+    finally:
+        executor.shutdown(wait=not running, cancel_futures=True)
+    return results
+
+def wsl_has_command(distro_name: str, command_name: str) -> bool:
+    """Check whether a command is available in the WSL shell."""
+    try:
+        run_command(f"command -v {shlex.quote(command_name)} >/dev/null", wsl=True, wsl_distro=distro_name)
+        return True
+    except subprocess.CalledProcessError:
+        return False
+
+def checkpoint_fingerprints(config: dict) -> dict:
+    """Return the input fingerprint of every pipeline stage, chained through the stages it builds on."""
+    fingerprints = {}
+    for name, (keys, depends_on) in CHECKPOINT_STAGE_INPUTS.items():
+        inputs = config if keys is None else {key: config.get(key) for key in keys}
+        payload = json.dumps({"inputs": inputs, "depends_on": {dep: fingerprints[dep] for dep in depends_on}},
+                             sort_keys=True, default=str)
+        fingerprints[name] = hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+    return fingerprints
+
+class PipelineCheckpoint:
+    """Records which pipeline stages completed in output_dir, and with which inputs.
+
+    checkpoint.json is rewritten whenever a stage starts or completes, so a failed
+    or cancelled run leaves a record of the stages that still hold. With resume,
+    a stage whose recorded fingerprint matches is skipped and its recorded result
+    is handed to the later stages instead.
+    """
+
+    def __init__(self, config: dict, resume: bool):
+        self.path = Path(config["output_dir"]).expanduser().resolve() / CHECKPOINT_FILE
+        self.fingerprints = checkpoint_fingerprints(config)
+        self.previous = load_state_file(self.path).get("stages", {}) if resume else {}
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def is_valid(self, name: str) -> bool:
+        entry = self.previous.get(name, {})
+        return entry.get("status") == "completed" and entry.get("fingerprint") == self.fingerprints[name]
+
+    def invalidate(self, name: str):
+        self.previous.pop(name, None)
+
+    def record(self, name: str, status: str, result=None):
+        with self.lock:
+            self.stages[name] = {"status": status, "fingerprint": self.fingerprints[name], "result": result,
+                                 "updated_at": datetime.datetime.now().isoformat(timespec="seconds")}
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            save_state_file(self.path, {"stages": self.stages})
+
+def prepare_resume(checkpoint: PipelineCheckpoint, distro_name: str) -> bool:
+    """Drop recorded stages that can no longer be reused before a resumed run.
+
+    Recorded checkouts have to still exist. When either tree stage has to run
+    again after a previous run modified the checkout, both are re-run on a clean
+    tree. Stages dropped here take the stages built on them along; changed
+    inputs already do so through the chained fingerprints. Returns True if the
+    tree reset is needed.
+    """
+    tree_touched = any(name in checkpoint.previous for name in CHECKPOINT_TREE_STAGES)
+    dropped = set()
+
+    recorded_dirs = {name: checkpoint.previous[name].get("result") for name in ("clone_kernel", "clone_nethunter")
+                     if checkpoint.is_valid(name) and checkpoint.previous[name].get("result")}
+    if recorded_dirs:
+        check_cmd = "; ".join(f"[ -d {shlex.quote(path)} ] || echo {name}" for name, path in recorded_dirs.items())
+        for name in run_command(f"{check_cmd}; true", wsl=True, wsl_distro=distro_name).split():
+            logger.info(f"Checkout recorded for {name} is gone; it will be fetched again")
+            dropped.add(name)
+
+    reset_tree = tree_touched and not all(checkpoint.is_valid(name) for name in CHECKPOINT_TREE_STAGES)
+    if reset_tree:
+        dropped.update(CHECKPOINT_TREE_STAGES)
+    for name, (_, depends_on) in CHECKPOINT_STAGE_INPUTS.items():
+        if dropped.intersection(depends_on):
+            dropped.add(name)
+    for name in dropped:
+        checkpoint.invalidate(name)
+    return reset_tree
+
+def run_build_pipeline(config: dict, args) -> dict:
+    """Run the whole customization pipeline for one configuration.
+
+    Environment setup and the two clones overlap; tweaks, patches and the build
+    follow in order once the sources are in place. Every stage is recorded in
+    output_dir/checkpoint.json; with --resume, stages still valid there are skipped.
+    """
+    distro_name = config["wsl_distro_name"]
+    reset_progress()
+
+    # Everything else needs a working shell, so this runs before the stages are scheduled
+    with instrument_stage("check_wsl"):
+        check_wsl_and_distro(distro_name)
+
+    checkpoint = PipelineCheckpoint(config, getattr(args, "resume", False))
+    reset_tree = prepare_resume(checkpoint, distro_name) if checkpoint.previous else False
+
+    # Cloning only has to wait for the package setup when git itself is missing
+    clone_deps = []
+    if not args.skip_env_setup and not args.skip_clone and not wsl_has_command(distro_name, "git"):
+        logger.info("git is not installed yet; cloning will start after environment setup.")
+        clone_deps.append("setup_env")
+
+    def sources_ready(results):
+        return results["clone_kernel"] and results["clone_nethunter"]
+
+    def checkpointed(name, func, skipped):
+        """Record the stage in the checkpoint, or hand out its recorded result while that is still valid."""
+        def run(results):
+            if skipped(results):
+                return func(results)
+            if checkpoint.is_valid(name):
+                logger.info(f"Resuming: {name} completed with the same inputs before, skipping it")
+                result = checkpoint.previous[name].get("result")
+                checkpoint.record(name, "completed", result)
+                return result
+            checkpoint.record(name, "running")
+            result = func(results)
+            checkpoint.record(name, "completed", result)
+            return result
+        return run
+
+    def apply_tweaks(results):
+        if not sources_ready(results):
+            return None
+        if reset_tree:
+            logger.info("Restoring a clean kernel tree before tweaks and patches are applied again")
+            run_command(f"cd '{results['clone_kernel']}' && git reset -q --hard && git clean -q -fd",
+                        wsl=True, wsl_distro=distro_name)
+        return apply_kernel_config_tweaks(results["clone_kernel"], config, args.skip_config_tweaks)
+
+    stages = [
+        PipelineStage("setup_env", checkpointed(
+            "setup_env", lambda r: setup_wsl_environment(config, args.skip_env_setup),
+            lambda r: args.skip_env_setup)),
+        PipelineStage("clone_kernel", checkpointed(
+            "clone_kernel", lambda r: clone_kernel_repository(config, args.skip_clone),
+            lambda r: args.skip_clone), clone_deps),
+        PipelineStage("clone_nethunter", checkpointed(
+            "clone_nethunter", lambda r: clone_nethunter_repository(config, args.skip_clone),
+            lambda r: args.skip_clone), clone_deps),
+        PipelineStage("config_tweaks", checkpointed(
+            "config_tweaks", apply_tweaks,
+            lambda r: args.skip_config_tweaks or not sources_ready(r)),
+            ["clone_kernel", "clone_nethunter"]),
+        PipelineStage("patches", checkpointed(
+            "patches", lambda r: apply_nethunter_patches(r["clone_kernel"], r["clone_nethunter"], config, args.skip_patches)
+            if sources_ready(r) else None,
+            lambda r: args.skip_patches or not sources_ready(r)),
+            ["config_tweaks"]),
+        PipelineStage("build", checkpointed(
+            "build", lambda r: build_kernel_in_wsl(r["clone_kernel"], config, args.skip_build)
+            if sources_ready(r) else None,
+            lambda r: args.skip_build or not sources_ready(r)),
+            ["patches", "setup_env"]),
+    ]
+    return run_pipeline(stages, config.get("pipeline_workers", 4))
+
+def set_config_value(config: dict, dotted_key: str, value):
+    """Set a possibly nested key such as "features.hid_support" in a config dict."""
+    *parents, leaf = dotted_key.split(".")
+    target = config
+    for parent in parents:
+        target = target.setdefault(parent, {})
+    target[leaf] = value
+
+def matrix_variant_name(overrides: dict) -> str:
+    """Derive a directory-safe variant name from its overrides."""
+    parts = [f"{key.split('.')[-1]}-{value}" for key, value in overrides.items()]
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", "_".join(parts)) or "default"
+
+def load_matrix(matrix_path_str: str):
+    """Load a build matrix file and return (base_config, [(variant_name, config), ...]).
+
+    The file is either a list of variants or an object with an optional base
+    ("base_config" path and/or "base" overrides), explicit "variants" and a
+    "grid" of dotted keys to value lists whose cartesian product is added.
+    A variant is a config file path or an object of overrides with an optional "name".
+    Without any base, a first variant given as a config file path is the base.
+    """
+    matrix_path = Path(matrix_path_str)
+    if not matrix_path.exists():
+        logger.error(f"Matrix file not found: {matrix_path}")
+        raise SystemExit(f"Matrix file {matrix_path} not found.")
+
+    try:
+        with open(matrix_path, "r", encoding="utf-8") as f:
+            matrix = json.load(f)
+    except json.JSONDecodeError as e:
+        logger.error(f"Error decoding JSON from {matrix_path}: {e}")
+        raise SystemExit(f"Invalid JSON in matrix file: {e}")
+    if isinstance(matrix, list):
+        matrix = {"variants": matrix}
+
+    matrix_dir = matrix_path.parent
+    first_variant = (matrix.get("variants") or [None])[0]
+    if "base_config" in matrix:
+        base_config = load_config(str(matrix_dir / matrix["base_config"]))
+    elif "base" not in matrix and isinstance(first_variant, str):
+        base_config = load_config(str(matrix_dir / first_variant))
+    else:
+        base_config = copy.deepcopy(DEFAULT_CONFIG)
+    for key, value in matrix.get("base", {}).items():
+        set_config_value(base_config, key, value)
+
+    variants = []
+    for entry in matrix.get("variants", []):
+        if isinstance(entry, str):
+            variants.append((Path(entry).stem, load_config(str(matrix_dir / entry))))
+            continue
+        overrides = dict(entry)
+        name = overrides.pop("name", None) or matrix_variant_name(overrides)
+        variant_config = copy.deepcopy(base_config)
+        for key, value in overrides.items():
+            set_config_value(variant_config, key, value)
+        variants.append((name, variant_config))
+
+    grid = matrix.get("grid", {})
+    grid_keys = list(grid)
+    for values in itertools.product(*(grid[key] for key in grid_keys)):
+        if not grid_keys:
+            break
+        overrides = dict(zip(grid_keys, values))
+        variant_config = copy.deepcopy(base_config)
+        for key, value in overrides.items():
+            set_config_value(variant_config, key, value)
+        variants.append((matrix_variant_name(overrides), variant_config))
+
+    if not variants:
+        raise SystemExit(f"Matrix file {matrix_path} does not define any variants.")
+    names = [name for name, _ in variants]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise SystemExit(f"Duplicate matrix variant names: {', '.join(duplicates)}")
+    return base_config, variants
+
+def build_matrix_variant(kernel_wsl_dir: str, name: str, config: dict, build_root: str,
+                         env_exports: str, make_vars: str, jobs: int) -> dict:
+    """Configure and compile one matrix variant in its own O= directory.
+
+    The variant's tweaks are merged into its own copy of the defconfig, written
+    as the build directory's .config, so the shared source tree is never modified.
+    """
+    defconfig_filename = config["defconfig_filename_template"].format(codename=config["codename"])
+    build_dir = f"{build_root}/{name}"
+    result = {"name": name, "codename": config["codename"], "build_dir": build_dir, "jobs": jobs}
+    started = time.monotonic()
+
+    try:
+        with instrument_stage(f"matrix/{name}"):
+            build_matrix_variant_steps(kernel_wsl_dir, name, config, build_dir, defconfig_filename,
+                                       env_exports, make_vars, jobs, result)
+        result["status"] = "success"
+        logger.info(f"[{name}] Build succeeded")
+    except subprocess.CalledProcessError as e:
+        result["status"] = "failed"
+        result["error"] = f"Command failed with exit status {e.returncode}"
+        logger.error(f"[{name}] Build failed")
+        if e.output:
+            logger.error(f"[{name}] Last output lines:\n{e.output}")
+    except SystemExit as e:
+        result["status"] = "failed"
+        result["error"] = str(e)
+        logger.error(f"[{name}] {e}")
+
+    result["duration_seconds"] = round(time.monotonic() - started, 1)
+    emit_event("matrix_result", f"MATRIX_RESULT: {json.dumps(result, sort_keys=True)}", **result)
+    return result
+
+def build_matrix_variant_steps(kernel_wsl_dir: str, name: str, config: dict, build_dir: str, defconfig_filename: str,
+                               env_exports: str, make_vars: str, jobs: int, result: dict):
+    """Write the variant's .config and compile it, filling in result as it goes."""
+    distro_name = config["wsl_distro_name"]
+    defconfig_text = run_command(f"cat '{kernel_wsl_dir.rstrip('/')}/{defconfig_filename}'",
+                                 wsl=True, wsl_distro=distro_name)
+    defconfig = merge_config_tweaks(Defconfig(defconfig_text), collect_config_tweaks(config))
+    result["config_changes"] = len(defconfig.diff())
+
+    run_command(f"mkdir -p '{build_dir}' && cat > '{build_dir}/.config'",
+                wsl=True, wsl_distro=distro_name, input=defconfig.text())
+    logger.info(f"[{name}] Building in {build_dir} with -j{jobs}")
+    run_command(f"cd '{kernel_wsl_dir}' && {env_exports} && make O='{build_dir}'{make_vars} olddefconfig",
+                wsl=True, wsl_distro=distro_name, stream=True)
+    if config.get("kernel_config_preflight", True):
+        preflight_kernel_config(kernel_wsl_dir, build_dir, config)
+    if config.get("preflight_only", False):
+        result["images"] = []
+        return
+    run_command(f"cd '{kernel_wsl_dir}' && {env_exports} && make O='{build_dir}'{make_vars} -j{jobs}",
+                wsl=True, wsl_distro=distro_name, stream=True)
+
+    artifacts_wsl_dir = f"{prepare_output_dir_wsl(config)}/{ARTIFACTS_DIR_NAME}/matrix/{name}"
+    files = collect_build_artifacts(build_dir, artifacts_wsl_dir, config)
+    result["images"] = [f"{artifacts_wsl_dir}/{f}" for f in files if f.startswith("boot/")]
+
+def cap_make_jobs(config: dict, limit: int) -> dict:
+    """Limit the config's make_jobs to limit, using limit itself when make_jobs is unset."""
+    requested_jobs = int(config.get("make_jobs", 0))
+    config["make_jobs"] = min(requested_jobs, limit) if requested_jobs > 0 else limit
+    return config
+
+def run_matrix(matrix_path_str: str, args, make_jobs_limit: int = None) -> list:
+    """Build every variant of a matrix file from one shared, patched checkout.
+
+    Variants build concurrently (matrix_parallel at a time) and split one global
+    make job budget instead of each using every core; make_jobs_limit caps the
+    local part of that budget. A per-variant summary is written to
+    matrix_summary.json in output_dir, next to build_report.json.
+    """
+    base_config, variants = load_matrix(matrix_path_str)
+    if make_jobs_limit:
+        cap_make_jobs(base_config, make_jobs_limit)
+    configure_shell(base_config)
+    apply_cli_options(base_config, args)
+    logger.info(f"Build matrix with {len(variants)} variant(s): {', '.join(name for name, _ in variants)}")
+
+    for name, variant_config in variants:
+        apply_cli_switches(variant_config, args)
+        mismatched = [key for key in MATRIX_SHARED_KEYS if variant_config.get(key) != base_config.get(key)]
+        if mismatched:
+            raise SystemExit(f"Matrix variant '{name}' changes shared settings ({', '.join(mismatched)}); "
+                             f"variants must build from the same sources.")
+
+    with build_log(base_config), build_report(base_config):
+        # Sources are cloned and patched once; each variant applies its own tweaks
+        shared_args = argparse.Namespace(**vars(args))
+        shared_args.skip_config_tweaks = True
+        shared_args.skip_build = True
+        kernel_wsl_dir = run_build_pipeline(base_config, shared_args)["clone_kernel"]
+        if not kernel_wsl_dir:
+            raise SystemExit("Matrix builds need the kernel sources; they cannot be combined with --skip-clone.")
+        if args.skip_build:
+            logger.info("Skipping matrix builds as requested.")
+            return []
+
+        step_update("Building matrix variants")
+        distro_name = base_config["wsl_distro_name"]
+        env_exports, make_vars, use_ccache, remote_slots = prepare_build_environment(kernel_wsl_dir, base_config)
+        run_command(f"cd '{kernel_wsl_dir}' && {env_exports} && {mrproper_if_configured_cmd(base_config)}",
+                    wsl=True, wsl_distro=distro_name)
+
+        # Never run more variants than there are make jobs to share between them
+        total_jobs = detect_make_jobs(base_config, remote_slots)
+        parallel = max(1, min(int(args.matrix_parallel or base_config.get("matrix_parallel", 2)), len(variants), total_jobs))
+        jobs_per_variant = max(1, total_jobs // parallel)
+        build_root = f"{kernel_wsl_dir.rstrip('/').rsplit('/', 1)[0]}/matrix"
+        progress_update(65, f"Building {len(variants)} variants, {parallel} at a time with -j{jobs_per_variant} each")
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = {
+                submit_in_context(executor, build_matrix_variant, kernel_wsl_dir, name, variant_config, build_root,
+                                  env_exports, make_vars, jobs_per_variant): name
+                for name, variant_config in variants
+            }
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                progress_update(65 + int(len(results) / len(variants) * 30), f"Variant {futures[future]} finished")
+
+        if use_ccache:
+            report_ccache_stats(env_exports, distro_name)
+        if remote_slots:
+            report_distributed_stats(env_exports, distro_name)
+
+        summary = [results[name] for name, _ in variants]
+        summary_path = Path(base_config["output_dir"]).expanduser().resolve() / "matrix_summary.json"
+        with open(summary_path, "w", encoding="utf-8") as f:
+            json.dump({"variants": summary}, f, indent=2)
+        logger.info(f"Matrix summary written to {summary_path}")
+
+        failed = [result["name"] for result in summary if result["status"] != "success"]
+        if failed:
+            raise SystemExit(f"{len(failed)} of {len(summary)} matrix variants failed: {', '.join(failed)}")
+        progress_update(100, f"All {len(summary)} matrix variants built successfully")
+        return summary
+
+def apply_cli_options(config: dict, args):
+    """Fold command line switches into the config and clean the output dir if requested."""
+    apply_cli_switches(config, args)
+
+    if args.clean_output:
+        output_dir = Path(config["output_dir"]).expanduser().resolve()
+        if output_dir.exists():
+            logger.info(f"Cleaning output directory: {output_dir}")
+            shutil.rmtree(output_dir)
+
+def apply_cli_switches(config: dict, args):
+    """Fold the command line switches that map to config keys into the config."""
+    if args.incremental:
+        config["incremental_build"] = True
+    if args.refresh_mirrors:
+        config["git_mirror_refresh"] = True
+    if args.skip_preflight:
+        config["kernel_config_preflight"] = False
+    if args.preflight_only:
+        config["preflight_only"] = True
+
+class JobRequestError(ValueError):
+    """A --serve request that cannot be turned into a job; reported as a JSON-RPC error."""
+
+class BuildWorker:
+    """Runs build jobs received over JSON-RPC with shared sessions, caches and CPU budget.
+
+    Requests are JSON-RPC 2.0 objects, one per line on stdin; responses and
+    "event" notifications are written one per line to stdout. Methods:
+
+      build     {"config": {...}} | {"config_path": str} | {"matrix_path": str},
+                optional "options" with command line switches such as
+                {"skip_clone": true} -> {"job_id": str}
+      status    {"job_id": str} (optional) -> job, or list of jobs
+      cancel    {"job_id": str} -> {"cancelled": bool}; only queued jobs can be cancelled
+      shutdown  {} -> {"stopping": true}; queued and running jobs are finished first
+
+    Each event carries job_id and type: "job" (status changes), "progress",
+    "step", "ccache", "distributed", "metric" or "matrix_result", with the fields of the
+    matching stdout line. Up to max_jobs jobs build at once, and each gets
+    cpu_budget // max_jobs make jobs at most. Jobs sharing an output_dir run
+    one after the other.
+    """
+
+    def __init__(self, args, parser: argparse.ArgumentParser):
+        self.max_jobs = max(1, args.max_jobs)
+        self.cpu_budget = max(1, args.cpu_budget or os.cpu_count() or 1)
+        self.jobs_per_build = max(1, self.cpu_budget // self.max_jobs)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_jobs)
+        self.default_options = vars(parser.parse_args(["--serve"]))
+        self.jobs = {}
+        self.futures = {}
+        self.jobs_lock = threading.Lock()
+        self.output_dir_locks = {}
+        self.shell = None
+
+    def send(self, message: dict):
+        emit_line(json.dumps({"jsonrpc": "2.0", **message}, sort_keys=True))
+
+    def send_event(self, job_id: str, event: dict):
+        self.send({"method": "event", "params": {"job_id": job_id, **event}})
+
+    def set_job_status(self, job: dict, status: str, error: str = None):
+        with self.jobs_lock:
+            job["status"] = status
+            if error:
+                job["error"] = error
+        self.send_event(job["job_id"], {"type": "job", "status": status, **({"error": error} if error else {})})
+
+    def job_config(self, params: dict) -> dict:
+        """Resolve the config of a build request, with make_jobs capped to the per-job budget."""
+        if "matrix_path" in params:
+            config = load_matrix(params["matrix_path"])[0]
+        elif "config_path" in params:
+            config = load_config(params["config_path"])
+        elif isinstance(params.get("config"), dict):
+            config = copy.deepcopy(DEFAULT_CONFIG)
+            config.update(params["config"])
+        else:
+            raise JobRequestError("build needs one of config, config_path or matrix_path")
+        return cap_make_jobs(config, self.jobs_per_build)
+
+    def pin_shell(self, config: dict):
+        """Pin the worker's shell to the first accepted job; later jobs must use the same one."""
+        # Sessions are shared by all jobs, so every job has to use the first job's shell
+        backend = config.get("wsl_backend", "wsl")
+        shell = (SHELL_BACKEND_ALIASES.get(backend, backend), config.get("wsl_persistent_session", True))
+        if self.shell is None:
+            configure_shell(config)
+            self.shell = shell
+        elif shell != self.shell:
+            raise JobRequestError(f"This worker runs jobs with wsl_backend={self.shell[0]} and "
+                                  f"wsl_persistent_session={self.shell[1]}")
+
+    def job_args(self, options: dict) -> argparse.Namespace:
+        allowed = set(self.default_options) - {"config", "matrix", "serve", "max_jobs", "cpu_budget"}
+        unknown = sorted(set(options) - allowed)
+        if unknown:
+            raise JobRequestError(f"Unknown build options: {', '.join(unknown)}")
+        return argparse.Namespace(**{**self.default_options, **options})
+
+    def submit(self, params: dict) -> dict:
+        try:
+            config = self.job_config(params)
+            options = params.get("options", {})
+            if not isinstance(options, dict):
+                raise JobRequestError("options must be an object")
+            args = self.job_args(options)
+            self.pin_shell(config)
+        except JobRequestError:
+            raise
+        except (SystemExit, ValueError, TypeError) as e:
+            raise JobRequestError(str(e))
+        job = {"job_id": uuid.uuid4().hex[:12], "status": "queued",
+               "device": config.get("device"), "codename": config.get("codename"),
+               "matrix_path": params.get("matrix_path")}
+        with self.jobs_lock:
+            self.jobs[job["job_id"]] = job
+        self.send_event(job["job_id"], {"type": "job", "status": "queued"})
+        # Every job gets a fresh context, so its events and progress stay its own
+        self.futures[job["job_id"]] = self.executor.submit(contextvars.Context().run, self.run_job, job, config, args)
+        return {"job_id": job["job_id"]}
+
+    def run_job(self, job: dict, config: dict, args: argparse.Namespace):
+        _event_sink.set(lambda event: self.send_event(job["job_id"], event))
+        # Jobs writing to the same output_dir would share one checkout, so they take turns
+        output_dir = str(Path(config["output_dir"]).expanduser().resolve())
+        with self.jobs_lock:
+            output_dir_lock = self.output_dir_locks.setdefault(output_dir, threading.Lock())
+        with output_dir_lock:
+            self.run_job_locked(job, config, args)
+
+    def run_job_locked(self, job: dict, config: dict, args: argparse.Namespace):
+        self.set_job_status(job, "running")
+        try:
+            if job["matrix_path"]:
+                run_matrix(job["matrix_path"], args, self.jobs_per_build)
+            else:
+                logger.info(f"[job {job['job_id']}] Building kernel for device: {config['device']} ({config['codename']})")
+                apply_cli_options(config, args)
+                with build_log(config, job["job_id"]), build_report(config):
+                    run_build_pipeline(config, args)
+            self.set_job_status(job, "completed")
+        except SystemExit as e:
+            logger.error(f"[job {job['job_id']}] Build failed: {e}")
+            self.set_job_status(job, "failed", str(e))
+        except Exception as e:
+            logger.error(f"[job {job['job_id']}] Unexpected error: {e}")
+            self.set_job_status(job, "failed", f"Unexpected error - {e}")
+
+    def status(self, params: dict):
+        with self.jobs_lock:
+            if "job_id" not in params:
+                return [dict(job) for job in self.jobs.values()]
+            if params["job_id"] not in self.jobs:
+                raise JobRequestError(f"Unknown job: {params['job_id']}")
+            return dict(self.jobs[params["job_id"]])
+
+    def cancel(self, params: dict) -> dict:
+        job_id = params.get("job_id")
+        if job_id not in self.futures:
+            raise JobRequestError(f"Unknown job: {job_id}")
+        cancelled = self.futures[job_id].cancel()
+        if cancelled:
+            self.set_job_status(self.jobs[job_id], "cancelled")
+        return {"cancelled": cancelled}
+
+    def handle(self, line: str) -> bool:
+        """Answer one request line; returns False once the worker should stop."""
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as e:
+            self.send({"id": None, "error": {"code": -32700, "message": f"Parse error: {e}"}})
+            return True
+        if not isinstance(request, dict):
+            self.send({"id": None, "error": {"code": -32600, "message": "Invalid request"}})
+            return True
+
+        request_id = request.get("id")
+        method = request.get("method")
+        params = request.get("params")
+        if params is None:
+            params = {}
+        handlers = {
+            "build": self.submit,
+            "status": self.status,
+            "cancel": self.cancel,
+            "shutdown": lambda p: {"stopping": True},
+        }
+        if method not in handlers:
+            self.send({"id": request_id, "error": {"code": -32601, "message": f"Method not found: {method}"}})
+            return True
+        if not isinstance(params, dict):
+            self.send({"id": request_id, "error": {"code": -32602, "message": "Invalid params: expected an object"}})
+            return True
+        try:
+            result = handlers[method](params)
+        except JobRequestError as e:
+            self.send({"id": request_id, "error": {"code": -32602, "message": str(e)}})
+            return True
+        except Exception as e:
+            # One bad request must not take down the jobs of everyone else
+            logger.error(f"Request {method} failed: {e}")
+            self.send({"id": request_id, "error": {"code": -32603, "message": f"Internal error: {e}"}})
+            return True
+        if request_id is not None:
+            self.send({"id": request_id, "result": result})
+        return method != "shutdown"
+
+    def run(self):
+        logger.info(f"Serving build jobs on stdin: {self.max_jobs} at a time, {self.jobs_per_build} make jobs each")
+        try:
+            for line in sys.stdin:
+                if line.strip() and not self.handle(line):
+                    break
+        finally:
+            self.executor.shutdown(wait=True)
+            close_sessions()
+        logger.info("Build worker stopped.")
+
+def serve(args, parser: argparse.ArgumentParser):
+    """Run the --serve worker until shutdown is requested or stdin closes."""
+    # stdout carries the JSON-RPC stream only; logs go to stderr and the log file
+    _console_handler.setStream(sys.stderr)
+    BuildWorker(args, parser).run()
+
+def build_arg_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description="Android Kernel Customizer for Windows using WSL",
         formatter_class=argparse.RawTextHelpFormatter
     )
-    parser.add_argument(
+    target_group = parser.add_mutually_exclusive_group(required=True)
+    target_group.add_argument(
         "--config", 
-        required=True,
         help="Path to kernel config JSON file"
     )
+    target_group.add_argument(
+        "--matrix",
+        help="Path to a build matrix JSON file (list of configs, or base config plus variants/grid)"
+    )
+    target_group.add_argument(
+        "--serve",
+        action="store_true",
+        help="Run as a worker that takes build jobs as JSON-RPC requests on stdin"
+    )
+    parser.add_argument(
+        "--max-jobs",
+        type=int,
+        default=1,
+        help="Number of --serve jobs that build at the same time"
+    )
+    parser.add_argument(
+        "--cpu-budget",
+        type=int,
+        help="Make jobs shared by all running --serve jobs (default: number of CPUs)"
+    )
+    parser.add_argument(
+        "--matrix-parallel",
+        type=int,
+        help="Number of matrix variants to build at the same time"
+    )
     parser.add_argument(
         "--skip-env-setup", 
         action="store_true", 
@@ -481,60 +2863,77 @@ def main():
         action="store_true", 
         help="Skip kernel build"
     )
+    parser.add_argument(
+        "--skip-preflight",
+        action="store_true",
+        help="Do not check that the requested config options survive config generation"
+    )
+    parser.add_argument(
+        "--preflight-only",
+        action="store_true",
+        help="Stop after generating and checking the kernel config, without compiling"
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Reuse the previous object tree when the kernel inputs are unchanged"
+    )
+    parser.add_argument(
+        "--refresh-mirrors",
+        action="store_true",
+        help="Fetch the latest branches into the git mirror cache before checking out"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the stages that output_dir/checkpoint.json records as completed with the same inputs"
+    )
     parser.add_argument(
         "--clean-output", 
         action="store_true", 
         help="Clean output directory before starting"
     )
+    return parser
 
+def main():
+    parser = build_arg_parser()
     args = parser.parse_args()
 
+    if args.serve:
+        serve(args, parser)
+        return
+
     try:
-        # Load configuration
-        config = load_config(args.config)
-        logger.info(f"Building kernel for device: {config['device']} ({config['codename']})")
-        
-        # Clean output directory if requested
-        if args.clean_output:
-            output_dir = Path(config["output_dir"]).expanduser().resolve()
-            if output_dir.exists():
-                logger.info(f"Cleaning output directory: {output_dir}")
-                shutil.rmtree(output_dir)
-        
-        # Check WSL environment
-        check_wsl_and_distro(config["wsl_distro_name"])
-        
-        # Set up WSL environment
-        setup_wsl_environment(config, args.skip_env_setup)
-        
-        # Clone repositories
-        kernel_dir, nethunter_dir = clone_repositories(config, args.skip_clone)
-        
-        if kernel_dir and nethunter_dir:
-            # Apply kernel configuration tweaks
-            apply_kernel_config_tweaks(kernel_dir, config, args.skip_config_tweaks)
-            
-            # Apply NetHunter patches
-            apply_nethunter_patches(kernel_dir, nethunter_dir, config, args.skip_patches)
-            
-            # Build kernel
-            build_kernel_in_wsl(kernel_dir, config, args.skip_build)
+        if args.matrix:
+            run_matrix(args.matrix, args)
+        else:
+            # Load configuration
+            config = load_config(args.config)
+            configure_shell(config)
+            logger.info(f"Building kernel for device: {config['device']} ({config['codename']})")
+            apply_cli_options(config, args)
+
+            # Check WSL, then set up, clone, tweak, patch and build
+            with build_log(config), build_report(config):
+                run_build_pipeline(config, args)
         
         logger.info("Kernel customization process completed successfully!")
-        print("BUILD_COMPLETE: Kernel customization finished successfully!", flush=True)
+        emit_line("BUILD_COMPLETE: Kernel customization finished successfully!")
         
     except KeyboardInterrupt:
         logger.info("Build process interrupted by user.")
-        print("BUILD_CANCELLED: Build was cancelled by user", flush=True)
+        emit_line("BUILD_CANCELLED: Build was cancelled by user")
         sys.exit(1)
     except SystemExit as e:
         logger.error(f"Build process failed: {e}")
-        print(f"BUILD_FAILED: {e}", flush=True)
+        emit_line(f"BUILD_FAILED: {e}")
         sys.exit(1)
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
-        print(f"BUILD_FAILED: Unexpected error - {e}", flush=True)
+        emit_line(f"BUILD_FAILED: Unexpected error - {e}")
         sys.exit(1)
+    finally:
+        close_sessions()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file